@@ -1,9 +1,8 @@
 import sys, os, getopt
 from pathlib import Path
-from datetime import datetime
 import pandas as pd
-import math
-from ast import literal_eval # Use ast.literal_eval to convert the string representation of list to acutual list
+import numpy as np
+from data_io import load_ac, write_table, check_format, stage_up_to_date, save_stage, FORMATS, DEFAULT_FORMAT
 
 def main():
     # Help message:
@@ -12,17 +11,18 @@ def main():
     Usage: python acc_reformat.py -f <filename> [options]
 
     Arguments:
-        -f: .csv file containing accelerometer data from raw files
+        -f: .parquet, .feather, or .csv file containing accelerometer data from raw files
 
     Options:
         -h or --help: print help document
         -b: bin size in seconds, 300s by default
+        --format: output file format, parquet (default if pyarrow is installed), feather, or csv
         -v: Verbose mode
     '''
     
     arg_list = sys.argv[1:]
     short_opts = 'f:b:hv'
-    long_opts = ['help']
+    long_opts = ['help','format=']
     global verbose
     verbose = False
     
@@ -42,47 +42,47 @@ def main():
     # Initialize variables
     file_name = ''
     binsize = 300
+    file_format = DEFAULT_FORMAT
     
     # Parse options
     for current_opt,current_val in opt_list:
         if current_opt == '-f':
-            file_name = validate_file(current_val,accepted_formats=['.csv'])[0]
+            file_name = validate_file(current_val,accepted_formats=list(FORMATS.values()))[0]
         elif current_opt == '-b':
-            msg(f'Bin size set to: {current_val} seconds')
-            binsize = current_val
+            try:
+                binsize = int(current_val)
+            except ValueError:
+                print(f'Invalid bin size: {current_val}. Must be an integer number of seconds.')
+                sys.exit(2)
+            msg(f'Bin size set to: {binsize} seconds')
+        elif current_opt == '--format':
+            file_format = current_val
+            format_err = check_format(file_format)
+            if format_err != '':
+                print(format_err)
+                sys.exit(2)
     
     if file_name == '':
         print('Missing file name. Exiting.')
         sys.exit(2)
     
     base_name=Path(file_name).absolute().parts[-2]
-    out_name=str(Path(file_name).parent) + "/0_" + base_name + "_ac_reformatted.csv"
-    if Path(out_name).exists():
-        print(f'{out_name} already exist, skipping.')
+    out_stem=str(Path(file_name).parent) + "/0_" + base_name + "_ac_reformatted"
+    # skip if the output was made from the same file with the same options (see data_io.stage_up_to_date)
+    params={'bin_size':binsize,'format':file_format}
+    if stage_up_to_date(Path(file_name).parent,'acc_reformat',[file_name],params,[out_stem + FORMATS[file_format]]):
+        print(f'{out_stem + FORMATS[file_format]} is up to date, skipping.')
         sys.exit(0)
     
     msg(f'Processing {file_name}')
-    ac=pd.read_csv(file_name)
-    ac['data']=ac['data'].apply(lambda x: literal_eval(x))
-    ac['date_time'] = pd.to_datetime(ac['date_time'])
+    ac=load_ac(file_name)
     
-    acc_df=acc_flatten(ac,match_range=6)
+    acc_df=acc_flatten(ac)
     msg('Data reformatting completed. Calculating combined accelerations...')
-    seconds=[]
-    intervals=[]
-    acc=[]
-    for i in range(0,len(acc_df),1):
-        s=acc_df["date_time"][i].hour*3600+acc_df["date_time"][i].minute*60+acc_df["date_time"][i].second+acc_df["date_time"][i].microsecond/1000000
-        seconds.append(s)
-        n=math.floor(s/binsize)
-        intervals.append(n)
-        g=math.sqrt(acc_df['acx'][i]**2+acc_df['acy'][i]**2+acc_df['acz'][i]**2)
-        acc.append(g)
-    acc_df['seconds']=seconds
-    acc_df['bin']=intervals
-    acc_df['g_force']=acc
+    acc_df=acc_calculate(acc_df,binsize=binsize)
     
-    acc_df.to_csv(out_name,index=False)
+    out_name=write_table(acc_df,out_stem,file_format=file_format)
+    save_stage(Path(file_name).parent,'acc_reformat',[file_name],params,[out_name])
     msg(f'Completed. Saved to {out_name}\n')
     
 # verbose function for printing messages
@@ -92,140 +92,103 @@ def msg(text):
         print(text)
 
 # Functions to convert the accceleration data to a single table with x, y, and z values on each row
-def acc_flatten(ac,match_range=6):
-    # set the top row containing a dummy datetime value
-    top_row = pd.DataFrame({'kind':'ac','date_time':datetime.fromtimestamp(1),'data':'NA'},index=[0])
+def acc_flatten(ac):
     # extract the three components of the acceleration
     ac_slim=ac[['kind','date_time','data']]
-    acx=pd.concat([top_row,ac_slim[ac_slim['kind']=='acx']]).reset_index(drop=True)
-    acx['date_time'] = pd.to_datetime(acx['date_time'])
-    acy=pd.concat([top_row,ac_slim[ac_slim['kind']=='acy']]).reset_index(drop=True)
-    acy['date_time'] = pd.to_datetime(acy['date_time'])
-    acz=pd.concat([top_row,ac_slim[ac_slim['kind']=='acz']]).reset_index(drop=True)
-    acz['date_time'] = pd.to_datetime(acz['date_time'])
+    acx=ac_slim[ac_slim['kind']=='acx'].reset_index(drop=True)
+    acy=ac_slim[ac_slim['kind']=='acy'].reset_index(drop=True)
+    acz=ac_slim[ac_slim['kind']=='acz'].reset_index(drop=True)
     nrows_ac = min(len(acx),len(acy),len(acz))
     if nrows_ac==0:
         raise Warning('Missing at least one of: acx, acy, acz. Process stopped.')
-        return
     # match up timestamps from the three dataframes
     msg('Matching acceleration timestamps.')
-    acc_filt=match_acc(acx,acy,acz,n=match_range)
-    acx,acy,acz=acc_filt[0],acc_filt[1],acc_filt[2]
-    nrows_ac = min(len(acx),len(acy),len(acz))
+    acx,acy,acz=match_acc(acx,acy,acz)
+    nrows_ac = len(acx)
     msg(str(nrows_ac) + " records in the filtered data. Starting to reformat.")
 
-    # Make a new dataframe with 4 columns
-    df = pd.DataFrame(columns=['acx','acy','acz','date_time'])
-    start_row = 0
-    start_time = datetime.fromtimestamp(1)
-    for i in range(1,nrows_ac,1):
-        dt=(acx['date_time'][i]-acx['date_time'][i-1]).total_seconds()
-        if dt>1: # reset start row and time if the gap is more than a second
-            start_row = i
-            start_time = acx['date_time'][i]
-        t_smooth=smooth_timestamp(start_row,i,start_time)
-        df_row=pd.DataFrame({'acx':acx['data'][i],'acy':acy['data'][i],'acz':acz['data'][i],'date_time':t_smooth})
-        df=pd.concat([df,df_row])
-        if i%1000 == 0:
-            msg(str(i) + '/' + str(nrows_ac) +' records processed.')
-    df.reset_index(drop=True,inplace=True)
-    df['date_time']=pd.to_datetime(df['date_time'])
+    # each record holds several samples (padded to the same number by load_ac), unpack them to one sample per row
+    # the number is taken before matching, so a day where no records match gives an empty table
+    n_samples=len(ac_slim['data'].iloc[0])
+    val_x=np.array(acx['data'].tolist(),dtype=float).reshape(nrows_ac,n_samples)
+    val_y=np.array(acy['data'].tolist(),dtype=float).reshape(nrows_ac,n_samples)
+    val_z=np.array(acz['data'].tolist(),dtype=float).reshape(nrows_ac,n_samples)
+    t_smooth=smooth_timestamp(acx['date_time'].to_numpy(dtype='datetime64[ns]'),n_samples=n_samples)
+    df=pd.DataFrame({'acx':val_x.ravel(),'acy':val_y.ravel(),'acz':val_z.ravel(),'date_time':t_smooth.ravel()})
     return df
 
-# Function to check that the three timestamps are within 0.5 seconds
-def xyz_match(x,y,z,t=0.5):
-    a=abs((x-y).total_seconds())
-    b=abs((y-z).total_seconds())
-    c=abs((y-z).total_seconds())
-    if max(a,b,c)>t:
-        return False
-    else: 
-        return True
+# Function to add seconds of the day, bin number, and combined acceleration (g_force) columns
+def acc_calculate(acc_df,binsize=300):
+    t=acc_df['date_time'].to_numpy(dtype='datetime64[ns]')
+    ns_of_day=(t-t.astype('datetime64[D]')).astype(np.int64)
+    seconds=ns_of_day//1000000000+(ns_of_day%1000000000)//1000/1000000
+    acc_df['seconds']=seconds
+    acc_df['bin']=np.floor(seconds/binsize).astype(np.int64)
+    acc_df['g_force']=np.sqrt(acc_df['acx'].values**2+acc_df['acy'].values**2+acc_df['acz'].values**2)
+    return acc_df
 
-# Function to find closest matches in following rows if current row doesn't match
-def find_match(list_x,list_y,list_z,t=0.4):
-    # generate all possible combinations of timestamps
-    t_comb=[]
-    i=0
-    while i < len(list_x):
-        j=0
-        while j < len(list_y):
-            k=0
-            while k < len(list_z):
-                m=xyz_match(list_x[i],list_y[j],list_z[k],t=t)
-                comb=(i,list_x[i],j,list_y[j],k,list_z[k],i+j+k,m)
-                t_comb.append(comb)
-                k=k+1
-            j=j+1
-        i=i+1
-    t_comb=pd.DataFrame(t_comb,columns=['index_x','time_x','index_y','time_y','index_z','time_z','total_changes','xyz_match'])
-    t_comb.sort_values(by='total_changes',inplace=True)
-    t_comb.reset_index(drop=True,inplace=True)
-    # find the first matching combo
-    for i in range(0,len(t_comb),1):
-        if t_comb['xyz_match'][i]:
-            return [t_comb['index_x'][i],t_comb['index_y'][i],t_comb['index_z'][i]]
-            break
-    return []
+# Function to pair every row of ref with the nearest row of other, within t seconds
+# Both inputs are sorted datetime64[ns] arrays. Returns the matched positions in ref and in other.
+# Each row of other is used at most once; when several ref rows compete for it, the closest one wins.
+def nearest_match(ref,other,t=0.5):
+    if len(ref)==0 or len(other)==0:
+        return np.array([],dtype=np.int64),np.array([],dtype=np.int64)
+    ref_ns=ref.view('i8')
+    other_ns=other.view('i8')
+    pos=np.searchsorted(other_ns,ref_ns)
+    left=np.clip(pos-1,0,len(other_ns)-1)
+    right=np.clip(pos,0,len(other_ns)-1)
+    d_left=np.abs(ref_ns-other_ns[left])
+    d_right=np.abs(other_ns[right]-ref_ns)
+    idx=np.where(d_right<d_left,right,left)
+    dist=np.minimum(d_left,d_right)
+    ref_idx=np.flatnonzero(dist<=int(t*1e9))
+    idx,dist=idx[ref_idx],dist[ref_idx]
+    if len(ref_idx)==0:
+        return ref_idx,idx
+    # nearest neighbours of a sorted array are non-decreasing, so rows competing for the same match are contiguous
+    new_run=np.concatenate(([True],idx[1:]!=idx[:-1]))
+    run_id=np.cumsum(new_run)-1
+    run_min=np.minimum.reduceat(dist,np.flatnonzero(new_run))
+    closest=np.flatnonzero(dist==run_min[run_id])
+    closest=closest[np.concatenate(([True],run_id[closest][1:]!=run_id[closest][:-1]))]
+    return ref_idx[closest],idx[closest]
 
-# Function to test if the current row matches; if not, find_match is called
-def match_acc(x,y,z,n):
-    a=0
-    t_x=x['date_time'].tolist()
-    val_x=x['data'].tolist()
-    t_y=y['date_time'].tolist()
-    val_y=y['data'].tolist()
-    t_z=z['date_time'].tolist()
-    val_z=z['data'].tolist()
-    # remove any necessary values
-    while a<(len(t_x)-n) and a<(len(t_y)-n) and a<(len(t_z)-n):
-        if not xyz_match(t_x[a],t_y[a],t_z[a]):
-            lx,ly,lz=t_x[a:a+n],t_y[a:a+n],t_z[a:a+n]
-            first_match=[]
-            first_match=first_match+find_match(lx,ly,lz)
-            ### Automatically increase n if match is not found. ###
-            while len(first_match)==0:
-                n=n+2
-                msg('Match range increased to ' + str(n))
-                lx,ly,lz=t_x[a:a+n],t_y[a:a+n],t_z[a:a+n]
-                first_match=[]
-                first_match=first_match+find_match(lx,ly,lz)
-                
-            for i in range(0,first_match[0],1):
-                t_x.pop(a)
-                val_x.pop(a)
-            for i in range(0,first_match[1],1):
-                t_y.pop(a)
-                val_y.pop(a)
-            for i in range(0,first_match[2],1):
-                t_z.pop(a)
-                val_z.pop(a)
-        a=a+1
-    # there are n rows at the end that this loop will not process. Since n is relatively small, those rows are just discarded.
-    del t_x[a:len(t_x)]
-    del val_x[a:len(val_x)]
-    del t_y[a:len(t_y)]
-    del val_y[a:len(val_y)]
-    del t_z[a:len(t_z)]
-    del val_z[a:len(val_z)]
+# Function to match up the x, y, and z records so that all timestamps are within t seconds of the y timestamp
+# Unmatched records in any of the three components are dropped. Runtime is linear in the number of records.
+def match_acc(x,y,z,t=0.5):
+    x,y,z=[df.sort_values(by='date_time',kind='stable') if not df['date_time'].is_monotonic_increasing else df for df in (x,y,z)]
+    t_x=x['date_time'].to_numpy(dtype='datetime64[ns]')
+    t_y=y['date_time'].to_numpy(dtype='datetime64[ns]')
+    t_z=z['date_time'].to_numpy(dtype='datetime64[ns]')
+    y_x,ix=nearest_match(t_y,t_x,t=t)
+    y_z,iz=nearest_match(t_y,t_z,t=t)
+    # keep the y records that found a match in both x and z
+    match_x=np.full(len(t_y),-1)
+    match_z=np.full(len(t_y),-1)
+    match_x[y_x]=ix
+    match_z[y_z]=iz
+    iy=np.flatnonzero((match_x>=0)&(match_z>=0))
+    ix,iz=match_x[iy],match_z[iy]
+    msg(f'{len(t_x)-len(ix)} acx, {len(t_y)-len(iy)} acy, {len(t_z)-len(iz)} acz records without a match removed.')
     # make three new dataframes to return
-    new_x=pd.DataFrame({'date_time':t_x,'data':val_x})
-    new_y=pd.DataFrame({'date_time':t_y,'data':val_y})
-    new_z=pd.DataFrame({'date_time':t_z,'data':val_z})
+    new_x=pd.DataFrame({'date_time':t_x[ix],'data':x['data'].values[ix]})
+    new_y=pd.DataFrame({'date_time':t_y[iy],'data':y['data'].values[iy]})
+    new_z=pd.DataFrame({'date_time':t_z[iz],'data':z['data'].values[iz]})
     return new_x,new_y,new_z
 
 # Function to smooth the timestamp gaps to 0.1 second
-def smooth_timestamp(start_row,current_row,start_time):
-    local_format='%Y-%m-%d %H:%M:%S.%f'
-    start_time=datetime.timestamp(start_time)
-    t0=(start_time-0.4)+0.5*(current_row-start_row)
-    t1,t2,t3,t4=t0+0.1,t0+0.2,t0+0.3,t0+0.4
-    t0f=datetime.fromtimestamp(t0).strftime(local_format)
-    t1f=datetime.fromtimestamp(t1).strftime(local_format)
-    t2f=datetime.fromtimestamp(t2).strftime(local_format)
-    t3f=datetime.fromtimestamp(t3).strftime(local_format)
-    t4f=datetime.fromtimestamp(t4).strftime(local_format)
-    return [t0f,t1f,t2f,t3f,t4f]
+# Records are spaced 0.5 s apart from the start of each continuous run, a run restarts after a gap of more than a second.
+# The record timestamp belongs to the last sample. Returns an array of shape (records, samples).
+def smooth_timestamp(record_times,n_samples=5,sample_interval=np.timedelta64(100,'ms')):
+    if len(record_times)==0:
+        return np.empty((0,n_samples),dtype='datetime64[ns]')
+    reset=np.concatenate(([True],np.diff(record_times)>np.timedelta64(1,'s')))
+    rows=np.arange(len(record_times))
+    start_row=np.maximum.accumulate(np.where(reset,rows,0))
+    record_interval=sample_interval*n_samples
+    t0=record_times[start_row]+(rows-start_row)*record_interval-(n_samples-1)*sample_interval
+    return t0[:,None]+np.arange(n_samples)*sample_interval
 
 ### validate file or directory exists
 def validate_file(file_path,accepted_formats=''): 
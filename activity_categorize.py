@@ -11,56 +11,30 @@ def search_files(dirname,pattern,recursive = False):
         file_list = sorted(Path(dirname).glob(pattern))
     return(file_list)
 
-def load_excel(file_name):
-    out_df = pd.DataFrame(columns=['Time','kind','data'])
-    feature_rename={ 'Heart rate (bpm)':'hr',
-                    'Diastolic (mmHg)':'bp_dia',
-                    'Systolic (mmHg)':'bp_sys',
-                    'SaO2 (%)':'spo2',
-                    'Body temperature (C)':'st', 
-                    'Pedometer':'step',
-                    'Total sleep':'sleep_total',
-                    'Deep sleep':'sleep_deep',
-                    'Light sleep':'sleep_light',
-                    'Event Markers':'Event_markers'}
-    wb = load_workbook(file_name)
-    for sheet in wb.worksheets:
-        data = sheet.values
-        header = next(data)
-        header = [feature_rename[x] if x in feature_rename else x for x in header]
-        data = list(data)
-        df = pd.DataFrame(data,columns=header)
-        if 'sleep_total' in header:
-            df['sleep_total'] = df['sleep_total'].apply(lambda x: to_minutes(x) if len(x) > 0 else x)
-            df['sleep_deep'] = df['sleep_deep'].apply(lambda x: to_minutes(x) if len(x) > 0 else x)
-            df['sleep_light'] = df['sleep_light'].apply(lambda x: to_minutes(x) if len(x) > 0 else x)
-        df = pd.melt(df, id_vars=['Time'], value_vars=header[1:], var_name='kind', value_name='data')
-        df = df[df['kind'] != 'Body temperature (F)']
-        df = df[df['data'] != '']
-        out_df = pd.concat([out_df,df],ignore_index=True)
-    out_df.reset_index(inplace = True, drop = True)
-    out_df.rename(columns={'Time':'date_time'},inplace=True)
-    out_df['date_time'] = pd.to_datetime(out_df['date_time'])
-    return(out_df)
-
-def to_minutes(t):
-    hs=t.strip('m').split('h')
-    return(int(hs[0])*60+int(hs[1]))
+# keep one file of each name in a file list, the newest one, when the same table was saved in more than one format
+# (e.g. a day processed again with another --format), so no data is loaded twice
+def newest_per_stem(file_list):
+    newest = {}
+    for f in file_list:
+        stem = f.with_suffix('')
+        if stem not in newest or f.stat().st_mtime > newest[stem].stat().st_mtime:
+            newest[stem] = f
+    for f in file_list:
+        if newest[f.with_suffix('')] != f:
+            print(f'Warning: {f} is skipped, using the newer {newest[f.with_suffix("")].name} instead.')
+    return(sorted(newest.values()))
 
-def load_csv(file_name,file_type = 'measurement'):
+# load a table saved by previous steps in csv, parquet, or feather format
+def load_table(file_name,file_type = 'measurement'):
     if file_type == 'measurement':
-        out_df = pd.read_csv(file_name,usecols=['date_time','kind','data'])
-        out_df['date_time'] = pd.to_datetime(out_df['date_time'])
+        out_df = read_table(file_name,columns=['date_time','kind','data'])
         out_df['kind'] = out_df['kind'].apply(lambda x: str(x))
         out_df['data'] = out_df['data'].apply(lambda x: float(x))
     elif file_type == 'acc':
-        out_df = pd.read_csv(file_name,usecols=['date_time','g_force'])
-        out_df['date_time'] = pd.to_datetime(out_df['date_time'])
+        out_df = read_table(file_name,columns=['date_time','g_force'])
         out_df['g_force'] = out_df['g_force'].apply(lambda x: float(x))
     elif file_type == 'acc_cat':
-        out_df = pd.read_csv(file_name,usecols=['start_time','end_time','category'])
-        out_df['start_time'] = pd.to_datetime(out_df['start_time'])
-        out_df['end_time'] = pd.to_datetime(out_df['end_time'])
+        out_df = read_table(file_name,columns=['start_time','end_time','category'])
     else:
         return()
     return(out_df)
@@ -89,121 +63,131 @@ def preliminary_intervals(df,reset_gap_hours = 12):
     sleep_intervals = np.array([*zip(sleep_start,times)])
     return(sleep_intervals)
 
-def merge_intervals(time_intervals):
-    time_intervals.sort()
-    output = []
-    output.append(time_intervals[0])
-    for i in time_intervals[1:]:
-        if output[-1][1] >= i[0]:
-            output[-1][1] = max(output[-1][1],i[1])
-        else:
-            output.append(i)
-    output = np.array(output)
-    return(output)
-
-def subtract_intervals(base, sub):
-    base_gen, sub_gen = (list(x) for x in base), (x for x in sub) # turn list into generator
-    a, b = next(base_gen),next(sub_gen)
-    out_list = []
-    while True:
-        if not check_overlap(a,b):
-            if a[1] < b[0]:
-                out_list.append(a)
-                try:
-                    a = next(base_gen)
-                except StopIteration:
-                    break
-            else:
-                try:
-                    b = next(sub_gen)
-                except StopIteration:
-                    remaining_base = [x for x in base_gen]
-                    out_list.append(a)
-                    out_list = out_list + remaining_base
-                    break
-        else:
-            if a[1] <= b[1]:
-                if a[0] <= b[0]:
-                    out_list.append([a[0],b[0]])
-                try:
-                    a = next(base_gen)
-                except StopIteration:
-                    break
-            else:
-                if a[0] <= b[0]:
-                    out_list.append([a[0],b[0]])
-                a = [b[1],a[1]]
-                try:
-                    b = next(sub_gen)
-                except StopIteration:
-                    remaining_base = [x for x in base_gen]
-                    out_list.append(a)
-                    out_list = out_list + remaining_base
-                    break
-    return(np.array(out_list))
-
-def check_overlap(interval_a, interval_b):
-    if (interval_a[0] < interval_b[0] and interval_a[1] < interval_b[0]) or (interval_a[0] > interval_b[1] and interval_a[1] > interval_b[1]):
-        return(False)
-    else:
-        return(True)
-    
-def sleep_acc_thresh(df,sleep_periods,quantiles = (0.025,0.975)):
-    df.sort_values(by = 'date_time', inplace = True)
-    timestamps = df['date_time'].values
-    filter_array = np.repeat(False, len(timestamps))
-    for p in sleep_periods:
-        ind = np.logical_and(timestamps >= p[0], timestamps <= p[1])
-        filter_array = np.logical_or(filter_array,ind)
-    filtered_df = df[filter_array].copy()
-    filtered_df.reset_index(drop = True, inplace = True)
-    sleep_g = filtered_df['g_force'].values
+# lower and upper quantiles of g_force during sleep. The samples in the sleep periods are selected with one mask (in_intervals),
+# and the quantiles are taken from the selected g_force values only, without copying or sorting the dataframe.
+# With sketch_bin, the quantiles are approximated from a histogram of g_force in bins of that width (see add_to_sketch)
+def sleep_acc_thresh(df,sleep_periods,quantiles = (0.025,0.975),sketch_bin = None):
+    sleep_g = sleep_g_force(df,sleep_periods)
+    if sketch_bin is not None:
+        return(sketch_quantiles(add_to_sketch(None,sleep_g,sketch_bin),quantiles,sketch_bin))
     thresholds = (np.quantile(sleep_g,quantiles[0]),np.quantile(sleep_g,quantiles[1]))
     return(thresholds)
 
-def acc_categorize(df,acc_threshold, bin_size = 5):
+# g_force values of the samples within the sleep periods
+def sleep_g_force(df,sleep_periods):
+    in_sleep = in_intervals(df['date_time'].to_numpy(),sleep_periods)
+    return(df['g_force'].to_numpy()[in_sleep])
+
+# approximate quantiles: the sketch counts values per bin of width bin_width (a pandas Series of counts indexed by bin number)
+# it can be filled one chunk of data at a time, so the values do not need to be held in memory together. Missing values are skipped.
+def add_to_sketch(sketch,values,bin_width):
+    values = values[~np.isnan(values)]
+    bins,counts = np.unique(np.floor(values / bin_width).astype(np.int64),return_counts = True)
+    new_counts = pd.Series(counts,index = bins,dtype = 'int64')
+    if sketch is None:
+        return(new_counts)
+    return(sketch.add(new_counts,fill_value = 0).astype('int64'))
+
+# quantiles from a sketch (error less than bin_width)
+# the k-th smallest value is placed evenly within its bin, then the quantile is interpolated between the two values around its
+# rank, like the default (linear) method of np.quantile
+def sketch_quantiles(sketch,quantiles,bin_width):
+    sketch = sketch.sort_index()
+    bins,counts = sketch.index.to_numpy(),sketch.to_numpy()
+    cum_counts = np.cumsum(counts)
+    def kth_value(k):
+        i = np.searchsorted(cum_counts,k,side = 'right')
+        return((bins[i] + (k - (cum_counts[i] - counts[i]) + 0.5) / counts[i]) * bin_width)
+    out = []
+    for q in quantiles:
+        rank = q * (cum_counts[-1] - 1)
+        low = int(np.floor(rank))
+        high = min(low + 1,cum_counts[-1] - 1)
+        out.append(kth_value(low) + (rank - low) * (kth_value(high) - kth_value(low)))
+    return(tuple(out))
+
+# categorize the acceleration in windows of bin_size minutes, by the percentage of g_force values outside the sleep thresholds
+def acc_categorize(df,acc_threshold, bin_size = 5, cutoffs = (5,10)):
     msg(f'Binning acceration data in {bin_size} minute windows')
-    df['date'] = df['date_time'].apply(lambda x: x.date())
-    start_time_list,end_time_list,category_list = [],[],[]
-    df['floored_date_time'] = time_bin(df['date_time'].values, bin_size)
+    counts = window_counts(df, acc_threshold, bin_size)
     msg('Finished binning, categorizing acceleration status in each window.')
-    for bin_time, bin_df in df.groupby('floored_date_time'):
-        start_time_list = start_time_list + [bin_time]
-        end_time_list = end_time_list + [bin_time + np.timedelta64(bin_size,'m')]
-        category_list = category_list + [bin_categorize(bin_df['g_force'].values,acc_threshold)]
-    out_df = pd.DataFrame({'start_time':start_time_list,'end_time':end_time_list,'category':category_list})
+    return(categorize_windows(counts, bin_size, cutoffs))
+
+# number of outliers (g_force outside acc_threshold) and of samples in each window, indexed by the window start time
+# all windows are handled at once: every sample gets its window number, and np.bincount adds up the outliers and samples per window.
+# The counts of separate parts of the data can be added together (DataFrame.add), so the data can also be counted one chunk at a time.
+def window_counts(df, acc_threshold, bin_size = 5):
+    valid = ~np.isnat(df['date_time'].values)
+    floored_date_time = time_bin(df['date_time'].values[valid], bin_size)
+    bin_times, bin_codes = np.unique(floored_date_time, return_inverse = True)
+    g_force = df['g_force'].values[valid]
+    outliers = np.logical_or(g_force < acc_threshold[0], g_force > acc_threshold[1])
+    counts = pd.DataFrame({'outliers':np.bincount(bin_codes[outliers], minlength = len(bin_times)),
+                           'samples':np.bincount(bin_codes, minlength = len(bin_times))},
+                          index = bin_times.astype('datetime64[ns]'))
+    return(counts)
+
+# category of each window from its outlier and sample counts, with consecutive windows of the same category merged
+def categorize_windows(counts, bin_size = 5, cutoffs = (5,10)):
+    percentage = counts['outliers'].values / counts['samples'].values * 100
+    bin_times = counts.index.values
+    out_df = pd.DataFrame({'start_time':bin_times,'end_time':bin_times + np.timedelta64(bin_size,'m'),'category':activity_level(percentage, cutoffs)})
     out_df = merge_windows(out_df)
     return(out_df)
 
+# read the acceleration files one chunk of at most chunk_rows rows at a time, with the same columns and types as load_table
+def acc_chunks(file_list, chunk_rows):
+    for f in file_list:
+        for chunk in read_table_chunks(f, columns = ['date_time','g_force'], chunk_rows = chunk_rows):
+            chunk['g_force'] = chunk['g_force'].astype(float)
+            yield chunk
+
+# chunked version of sleep_acc_thresh and acc_categorize for acceleration data too large to load at once, in two passes over the files.
+# Pass one keeps only the g_force values within the sleep periods (or only their histogram with sketch_bin) to find the thresholds,
+# pass two adds up the window counts of each chunk. The results are the same as loading all files and calling the two functions.
+def stream_acc_categorize(file_list, sleep_periods, chunk_rows, bin_size = 5, cutoffs = (5,10), quantiles = (0.025,0.975), sketch_bin = None):
+    msg(f'Finding sleep g_force thresholds, reading {chunk_rows} rows at a time.')
+    sleep_g, sketch = [], None
+    for chunk in acc_chunks(file_list, chunk_rows):
+        if sketch_bin is not None:
+            sketch = add_to_sketch(sketch, sleep_g_force(chunk, sleep_periods), sketch_bin)
+        else:
+            sleep_g.append(sleep_g_force(chunk, sleep_periods))
+    if sketch_bin is not None:
+        acc_thresh = sketch_quantiles(sketch, quantiles, sketch_bin)
+    else:
+        sleep_g = np.concatenate(sleep_g)
+        acc_thresh = (np.quantile(sleep_g,quantiles[0]),np.quantile(sleep_g,quantiles[1]))
+        del sleep_g
+    msg(f'Binning acceration data in {bin_size} minute windows')
+    counts = None
+    for chunk in acc_chunks(file_list, chunk_rows):
+        chunk_counts = window_counts(chunk, acc_thresh, bin_size)
+        counts = chunk_counts if counts is None else counts.add(chunk_counts, fill_value = 0)
+    msg('Finished binning, categorizing acceleration status in each window.')
+    return(acc_thresh, categorize_windows(counts.sort_index(), bin_size, cutoffs))
+
+# floor the times to the start of their window of window minutes
 def time_bin(t_array, window = 5):
     t_array = t_array.astype('datetime64[m]').astype(int)
-    t_array = t_array // window * 5
+    t_array = t_array // window * window
     t_array = t_array.astype('datetime64[m]')
     return(t_array)
 
-def bin_categorize(g_force_array,thresholds, cutoffs = (5,10)):
-    outliers = np.logical_or(g_force_array < thresholds[0], g_force_array > thresholds[1])
-    percentage = sum(outliers) / len(outliers) * 100
-    if percentage > cutoffs[1]:
-        return('high active')
-    elif percentage > cutoffs[0]:
-        return('low active')
-    else:
-        return('rest')
+# category of each window from the percentage of outliers: above cutoffs[1] is high active, above cutoffs[0] is low active
+def activity_level(percentage, cutoffs = (5,10)):
+    return(np.select([percentage > cutoffs[1], percentage > cutoffs[0]], ['high active','low active'], default = 'rest'))
 
+# merge consecutive windows of the same category into one period
+# a new period starts where the category changes or where a window does not start at the end of the previous one.
+# Merged periods never meet these conditions, so merging again does not change the table.
 def merge_windows(df):
-    df_gen = (x for x in df.values)
-    current_start, current_end, current_cat = next(df_gen)
-    start_list, end_list, cat_list = [],[],[]
-    for ti in df_gen:
-        if (current_cat != ti[2]) or (ti[0] != current_end):
-            start_list.append(current_start)
-            end_list.append(current_end)
-            cat_list.append(current_cat)
-            current_start, current_end, current_cat = ti
-        else: 
-            current_end = ti[1]
-    out_df = pd.DataFrame({'start_time':start_list,'end_time':end_list,'category':cat_list})
+    if len(df) == 0:
+        return df[['start_time','end_time','category']].reset_index(drop=True)
+    starts, ends, categories = df['start_time'].values, df['end_time'].values, df['category'].values
+    new_period = np.concatenate(([True], (categories[1:] != categories[:-1]) | (starts[1:] != ends[:-1])))
+    last_window = np.append(np.flatnonzero(new_period)[1:] - 1, len(df) - 1)
+    out_df = pd.DataFrame({'start_time':starts[new_period],'end_time':ends[last_window],'category':categories[new_period]})
     return(out_df)
 
 def main():
@@ -212,20 +196,28 @@ def main():
     Usage: python activity_categorize.py -f <input_files> -a <acceleration_files> -s <save_name>  [options]
 
     Arguments:
-        -f: Input file, .xlsx or .csv. Can provide a directory, the script will search all files with corresponding file extensions (see -e below)
-        -a: Reformatted acceleration table. Can provide a directory; the script will perform recursive search for files ending in *ac_reformatted.csv and load all of them.
-            --acc_cat: Alternative to -a, provide a pre-existing acceleration catagorizing table in .csv format.
+        -f: Input file, .xlsx, .csv, .parquet, or .feather. Can provide a directory, the script will search all files with corresponding file extensions (see -e below)
+        -a: Reformatted acceleration table. Can provide a directory; the script will perform recursive search for files named *ac_reformatted.csv (or .parquet/.feather) and load all of them.
+            If a file was saved in more than one format, only the newest one is loaded.
+            --acc_cat: Alternative to -a, provide a pre-existing acceleration catagorizing table in .csv, .parquet, or .feather format.
         -s: save file location and name stem, e.g. output/directory/subject_id
 
     Options:
         -h or --help: print help document
-        -e: file extension for -d, "csv" or "xlsx" (default 'csv')
+        -e: file extension for -d, "csv", "parquet", "feather", or "xlsx" (default 'csv')
+        --format: output file format, parquet (default if pyarrow is installed), feather, or csv
+        -b: window size in minutes for categorizing the acceleration (default 5)
+        --cutoffs: percentages of outlier g_force values in a window above which it is low active and high active (default 5,10)
+        --sketch: approximate the sleep g_force quantiles with a histogram in bins of this width (g_force units, e.g. 1) instead of sorting all values
+        --chunk-rows: read the acceleration files in chunks of this many rows in two passes instead of loading them all at once, for data too large for memory.
+            Only the g_force values during sleep are kept (none with --sketch); the results are the same.
+        --xlsx-cache: save parsed copies of .xlsx input files next to them (in .xlsx_cache), used again while the files are unchanged
         -v: verbose mode
     '''
     # read arguments from command line and parse options
     arg_list = sys.argv[1:]
-    short_opts = 'a:f:e:s:hv'
-    long_opts = ['help','acc_cat=']
+    short_opts = 'a:f:e:s:b:hv'
+    long_opts = ['help','acc_cat=','format=','xlsx-cache','sketch=','cutoffs=','chunk-rows=']
     global verbose
     verbose = False
     try:
@@ -243,6 +235,12 @@ def main():
     # initialize variables and process arguments
     dir_name,file_list,acc_file,acc_cat,save_name = None, None, None, None, None
     search_pattern = 'csv'
+    file_format = DEFAULT_FORMAT
+    xlsx_cache = False
+    sketch_bin = None
+    chunk_rows = None
+    bin_size = 5
+    cutoffs = (5,10)
     for current_arg, current_val in opt_list:
         if current_arg == '-f':
             if Path(current_val).is_file():
@@ -258,35 +256,83 @@ def main():
             if Path(current_val).is_file():
                 acc_file = [current_val]
             elif Path(current_val).is_dir():
-                acc_file = search_files(current_val, '*ac_reformatted.csv',recursive=True)
+                acc_file = search_files(current_val, '*ac_reformatted.*',recursive=True)
+                acc_file = newest_per_stem([f for f in acc_file if f.suffix in FORMATS.values()])
             else:
                 print('Please provide valid path to acceleration file or directory.')
         elif current_arg == '--acc_cat':
             acc_cat = current_val
         elif current_arg == '-s':
             save_name = current_val
+        elif current_arg == '--format':
+            file_format = current_val
+            format_err = check_format(file_format)
+            if format_err != '':
+                sys.exit(format_err)
+        elif current_arg == '--xlsx-cache':
+            xlsx_cache = True
+        elif current_arg == '-b':
+            try:
+                bin_size = int(current_val)
+            except ValueError:
+                sys.exit(f'Error: Invalid window size: {current_val}')
+            if bin_size <= 0:
+                sys.exit(f'Error: Invalid window size: {current_val}')
+        elif current_arg == '--cutoffs':
+            try:
+                cutoffs = tuple(float(x) for x in current_val.split(','))
+            except ValueError:
+                cutoffs = ()
+            if len(cutoffs) != 2 or cutoffs[0] > cutoffs[1]:
+                sys.exit(f'Error: Invalid cutoffs: {current_val}. Use two percentages separated by a comma, e.g. 5,10')
+        elif current_arg == '--sketch':
+            try:
+                sketch_bin = float(current_val)
+            except ValueError:
+                sys.exit(f'Error: Invalid bin width: {current_val}')
+            if sketch_bin <= 0:
+                sys.exit(f'Error: Invalid bin width: {current_val}')
+        elif current_arg == '--chunk-rows':
+            try:
+                chunk_rows = int(current_val)
+            except ValueError:
+                sys.exit(f'Error: Invalid chunk size: {current_val}')
+            if chunk_rows <= 0:
+                sys.exit(f'Error: Invalid chunk size: {current_val}')
     
     if dir_name is not None:
         file_list = search_files(dir_name,search_pattern)
         if len(file_list) == 0:
             sys.exit(f'Error: No file with pattern "{search_pattern}" found within {dir_name}.')
 
+    # skip if the outputs were made from the same files with the same options (see data_io.stage_up_to_date)
+    # chunk_rows is not a parameter of the results, which are the same with or without it
+    save_dir, stage = Path(save_name).parent, 'activity_categorize:' + Path(save_name).name
+    inputs = list(file_list) + (list(acc_file) if acc_cat is None else [acc_cat])
+    params = {'acc_cat':acc_cat is not None,'bin_size':bin_size,'cutoffs':cutoffs,'sketch':sketch_bin,'format':file_format}
+    outputs = [save_name + '_activity_categorized' + FORMATS[file_format]]
+    if acc_cat is None:
+        outputs += [save_name + '_sleep_acc_thresholds.csv', save_name + '_acc_category' + FORMATS[file_format]]
+    if stage_up_to_date(save_dir, stage, inputs, params, outputs):
+        print(f'{save_name} results are up to date, skipping.')
+        return
+
     # Load data
     msg('Loading measurement data.')
     measurements = pd.DataFrame()
     for f in file_list:
-        if Path(f).suffix == '.csv':
-            measurements = pd.concat([measurements,load_csv(f)])
+        if Path(f).suffix in FORMATS.values():
+            measurements = pd.concat([measurements,load_table(f)])
         elif Path(f).suffix == '.xlsx':
-            measurements = pd.concat([measurements,load_excel(f)])
+            measurements = pd.concat([measurements,load_excel(f,cache=xlsx_cache)])
     
     msg('Loading acceleration data.')
     acc_df = pd.DataFrame()
     if acc_cat is not None:
-        categorized_acc = load_csv(acc_cat,file_type='acc_cat')
-    else:
+        categorized_acc = load_table(acc_cat,file_type='acc_cat')
+    elif chunk_rows is None:
         for f in acc_file:
-            acc_df = pd.concat([acc_df,load_csv(f,file_type = 'acc')])
+            acc_df = pd.concat([acc_df,load_table(f,file_type = 'acc')])
     
     # Calculate primary sleep intervals
     msg('Calculating sleep intervals.')
@@ -298,17 +344,19 @@ def main():
     dt = np.timedelta64(10,'m')
     step_df = extract_kind(measurements,kind='step')
     step_df = step_df[step_df['data'] > 0]
-    step_increase = np.array([[t-dt,t] for t in step_df['date_time'].to_numpy()])
+    step_times = step_df['date_time'].to_numpy()
+    step_increase = np.column_stack((step_times - dt,step_times))
     
     # Subtract step increase periods from primary sleep intervals
     sleep_intervals = subtract_intervals(sleep_intervals,step_increase)
     
     msg('Processing and categorizing acceleration data.')
-    if acc_cat is None:
+    if acc_cat is None and chunk_rows is not None:
+        acc_thresh, categorized_acc = stream_acc_categorize(acc_file, sleep_intervals, chunk_rows, bin_size = bin_size, cutoffs = cutoffs, sketch_bin = sketch_bin)
+    elif acc_cat is None:
         # Find baseline acceleration boundaries
-        acc_thresh = sleep_acc_thresh(acc_df,sleep_intervals)
-        categorized_acc = acc_categorize(acc_df, acc_thresh)
-        categorized_acc = merge_windows(categorized_acc)
+        acc_thresh = sleep_acc_thresh(acc_df,sleep_intervals,sketch_bin = sketch_bin)
+        categorized_acc = acc_categorize(acc_df, acc_thresh, bin_size = bin_size, cutoffs = cutoffs)
     active_periods = categorized_acc[categorized_acc['category'] != 'rest']
     final_cat_df = active_periods.copy()
     active_periods = active_periods[['start_time','end_time']].values
@@ -336,10 +384,9 @@ def main():
         thresh_save_name = save_name + '_sleep_acc_thresholds.csv'
         with open(thresh_save_name,'w') as f:
             f.write(f'lower_threshold,{acc_thresh[0]}\nupper_threshold,{acc_thresh[1]}\n')
-        acc_cat_save_name = save_name + '_acc_category.csv'
-        categorized_acc.to_csv(acc_cat_save_name,index=False)
-    category_df_save_name = save_name + '_activity_categorized.csv'
-    final_cat_df.to_csv(category_df_save_name,index=False)
+        write_table(categorized_acc,save_name + '_acc_category',file_format=file_format)
+    write_table(final_cat_df,save_name + '_activity_categorized',file_format=file_format)
+    save_stage(save_dir, stage, inputs, params, outputs)
     msg('All done.')
 
     
@@ -348,5 +395,6 @@ if __name__ == '__main__':
     import pandas as pd
     import numpy as np
     from pathlib import Path
-    from openpyxl import load_workbook
+    from data_io import read_table, read_table_chunks, write_table, stage_up_to_date, save_stage, load_excel, check_format, FORMATS, DEFAULT_FORMAT
+    from time_intervals import merge_intervals, subtract_intervals, in_intervals
     main()
\ No newline at end of file
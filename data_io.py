@@ -0,0 +1,500 @@
+import io, os, json, hashlib, zipfile
+from collections import OrderedDict
+from pathlib import Path
+import numpy as np
+import pandas as pd
+try:
+    import pyarrow # engine for parquet and feather files
+    import pyarrow.ipc, pyarrow.parquet
+except ImportError:
+    pyarrow = None
+try:
+    from openpyxl import load_workbook # reader for computed data exported to .xlsx
+except ImportError:
+    load_workbook = None
+
+# Shared loading and saving functions for the intermediate files written by the pipeline scripts
+
+# Supported table formats and their file extensions. Parquet is used by default when pyarrow is installed.
+FORMATS = {'csv':'.csv','parquet':'.parquet','feather':'.feather'}
+DEFAULT_FORMAT = 'parquet' if pyarrow is not None else 'csv'
+DATETIME_COLUMNS = ['date_time','start_time','end_time']
+# Number of cells per block written to csv files (the pandas default). Datetime columns are formatted one block at a time,
+# so tables written in parts use the same blocks to get the same text as tables written at once.
+CSV_BLOCK_CELLS = 100000
+
+# Function to check that a file format is supported. Returns an error message, or '' if the format can be used.
+def check_format(file_format):
+    if file_format not in FORMATS:
+        return f'Unsupported file format: {file_format}. Must be one of: {", ".join(FORMATS)}.'
+    if file_format != 'csv' and pyarrow is None:
+        return f'The {file_format} format requires pyarrow, which is not installed. Use --format=csv instead.'
+    return ''
+
+# Function to find the format of a file from its extension, or from the file header if the extension is not known
+def detect_format(file_name):
+    suffix = Path(file_name).suffix.lower()
+    for file_format,ext in FORMATS.items():
+        if suffix == ext:
+            return file_format
+    with open(file_name,'rb') as f:
+        magic = f.read(6)
+    if magic[:4] == b'PAR1':
+        return 'parquet'
+    elif magic == b'ARROW1':
+        return 'feather'
+    return 'csv'
+
+# Function to save a table. file_stem is the file name without extension; returns the full file name.
+# Typed formats keep datetime64 columns, store kind as a category, and store list columns (e.g. acceleration samples) as arrays.
+def write_table(df,file_stem,file_format=DEFAULT_FORMAT):
+    file_name = str(file_stem) + FORMATS[file_format]
+    if file_format == 'csv':
+        df.to_csv(file_name,index=False,chunksize=csv_block_rows(len(df.columns)))
+        return file_name
+    df = df.reset_index(drop=True)
+    if 'kind' in df.columns:
+        df['kind'] = df['kind'].astype('category')
+    if 'data' in df.columns and df['data'].dtype == object:
+        try:
+            df['data'] = pd.to_numeric(df['data'])
+        except (ValueError,TypeError): # list columns are kept as they are
+            pass
+    if file_format == 'parquet':
+        df.to_parquet(file_name,index=False)
+    else:
+        df.to_feather(file_name)
+    return file_name
+
+# Function to save a table given as a sequence of parts, without holding the whole table in memory
+# load_parts is a function that returns an iterator over the parts (dataframes with the same columns), in order.
+# The parts are read twice: once to find the common column types, then to write them.
+# The saved file is the same as write_table on the concatenated parts.
+def write_table_parts(load_parts,file_stem,file_format=DEFAULT_FORMAT):
+    file_name = str(file_stem) + FORMATS[file_format]
+    columns,part_dtypes,kinds,numeric,n_rows = None,{},set(),[],0
+    object_types = {}
+    for part in load_parts():
+        if columns is None:
+            columns,first = list(part.columns),part.iloc[0:0]
+        n_rows += len(part)
+        for col in columns:
+            part_dtypes.setdefault(col,[]).append(part[col].dtype)
+        if 'kind' in columns:
+            kinds.update(part['kind'].unique())
+        if file_format != 'csv' and len(part) > 0:
+            # types the parts would get from write_table
+            numeric.append(to_numeric_dtype(part['data']) if 'data' in columns else None)
+            for col in columns:
+                if part[col].dtype == object and col != 'kind':
+                    object_types.setdefault(col,[]).append(pyarrow.array(part[col],from_pandas=True).type)
+    if columns is None:
+        raise ValueError(f'No data to save in {file_name}')
+    if n_rows == 0:
+        return write_table(first,file_stem,file_format=file_format)
+    dtypes = {col:common_dtype(part_dtypes[col]) for col in columns}
+
+    if file_format == 'csv':
+        block = csv_block_rows(len(columns))
+        header,buffer = True,[]
+        for part in load_parts():
+            buffer.append(part.astype(dtypes))
+            if sum(len(x) for x in buffer) >= block:
+                buffer = [pd.concat(buffer,ignore_index=True)]
+                n_full = len(buffer[0]) // block * block
+                buffer[0].iloc[:n_full].to_csv(file_name,index=False,header=header,mode='w' if header else 'a',chunksize=block)
+                buffer,header = [buffer[0].iloc[n_full:]],False
+        if len(buffer) > 0 or header:
+            pd.concat(buffer,ignore_index=True).to_csv(file_name,index=False,header=header,mode='w' if header else 'a',chunksize=block)
+        return file_name
+
+    # parquet and feather: same conversions as write_table, with one set of kind categories and one schema for all parts
+    categories = sorted(kinds)
+    numeric_data = 'data' in columns and dtypes['data'] == object and all(x is not None for x in numeric)
+    if numeric_data:
+        dtypes['data'] = common_dtype(numeric)
+    def prepare(part):
+        part = part.reset_index(drop=True)
+        if numeric_data:
+            part['data'] = pd.to_numeric(part['data'])
+        part = part.astype(dtypes)
+        if 'kind' in columns:
+            part['kind'] = pd.Categorical(part['kind'],categories=categories)
+        return part
+    schema = None
+    for part in load_parts():
+        if len(part) > 0:
+            schema = pyarrow.Schema.from_pandas(prepare(part),preserve_index=False)
+            break
+    for col,types in object_types.items():
+        if dtypes[col] == object:
+            field = pyarrow.unify_schemas([pyarrow.schema([(col,t)]) for t in types],promote_options='permissive').field(col)
+            schema = schema.set(schema.get_field_index(col),field)
+    if file_format == 'parquet':
+        writer = pyarrow.parquet.ParquetWriter(file_name,schema)
+    else:
+        writer = pyarrow.ipc.new_file(file_name,schema,options=pyarrow.ipc.IpcWriteOptions(compression='lz4'))
+    with writer:
+        for part in load_parts():
+            if len(part) > 0:
+                writer.write_table(pyarrow.Table.from_pandas(prepare(part),preserve_index=False).cast(schema))
+    return file_name
+
+# Function to find the dtype of a column made by concatenating columns of the given dtypes
+def common_dtype(dtypes):
+    dtypes = list(dict.fromkeys(dtypes))
+    if len(dtypes) == 1:
+        return dtypes[0]
+    if all(d.kind in 'iuf' for d in dtypes):
+        return np.result_type(*dtypes)
+    return np.dtype(object)
+
+# Function to find the dtype pd.to_numeric gives a column, or None if the values are not numbers
+def to_numeric_dtype(values):
+    if values.dtype != object:
+        return values.dtype
+    try:
+        return pd.to_numeric(values).dtype
+    except (ValueError,TypeError):
+        return None
+
+# Function to find the number of rows in one block of a csv file
+def csv_block_rows(n_columns):
+    return max(CSV_BLOCK_CELLS // max(n_columns,1),1)
+
+# Function to load a table saved in any of the supported formats; the format is detected from the file
+# Datetime columns are parsed while reading csv files. dtype maps column names to types, e.g. {'data':'float64'}
+def read_table(file_name,columns=None,dtype=None):
+    file_format = detect_format(file_name)
+    if file_format == 'csv':
+        header = pd.read_csv(file_name,nrows=0).columns
+        dates = [col for col in DATETIME_COLUMNS if col in header and (columns is None or col in columns)]
+        if dtype is not None:
+            dtype = {col:t for col,t in dtype.items() if col in header}
+        return pd.read_csv(file_name,usecols=columns,dtype=dtype,parse_dates=dates)
+    if file_format == 'parquet':
+        df = pd.read_parquet(file_name,columns=columns)
+    else:
+        df = pd.read_feather(file_name,columns=columns)
+    if dtype is not None:
+        df = df.astype({col:t for col,t in dtype.items() if col in df.columns})
+    return df
+
+# Function to read a table in chunks of at most chunk_rows rows (a generator of data frames), so only one chunk is in memory at a time
+# The chunks have the same columns and types as read_table gives for the whole file.
+def read_table_chunks(file_name,columns=None,chunk_rows=1000000):
+    file_format = detect_format(file_name)
+    if file_format == 'csv':
+        header = pd.read_csv(file_name,nrows=0).columns
+        dates = [col for col in DATETIME_COLUMNS if col in header and (columns is None or col in columns)]
+        with pd.read_csv(file_name,usecols=columns,parse_dates=dates,chunksize=chunk_rows) as reader:
+            yield from reader
+        return
+    if file_format == 'parquet':
+        batches = pyarrow.parquet.ParquetFile(file_name).iter_batches(batch_size=chunk_rows,columns=columns)
+    else:
+        reader = pyarrow.ipc.open_file(pyarrow.memory_map(str(file_name)))
+        batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+        if columns is not None:
+            batches = (batch.select(columns) for batch in batches)
+    for batch in batches:
+        for start in range(0,batch.num_rows,chunk_rows):
+            yield batch.slice(start,chunk_rows).to_pandas()
+
+# Function to load a file through a cache of parsed copies in cache_dir (no cache if cache_dir is None)
+# load is the function that parses the file. The cached copy is found by the function name and the path, modification time,
+# and size of the file, so it is used again only while the file is unchanged.
+def cached_load(load,file_name,cache_dir=None):
+    if cache_dir is None:
+        return load(file_name)
+    stat = os.stat(file_name)
+    key = f'{load.__module__}.{load.__qualname__}|{os.path.abspath(file_name)}|{stat.st_mtime_ns}|{stat.st_size}'
+    cache_file = os.path.join(cache_dir,hashlib.sha1(key.encode()).hexdigest() + '.pkl')
+    if os.path.exists(cache_file):
+        return pd.read_pickle(cache_file)
+    df = load(file_name)
+    os.makedirs(cache_dir,exist_ok=True)
+    temp_file = f'{cache_file}.{os.getpid()}.tmp'
+    df.to_pickle(temp_file)
+    os.replace(temp_file,cache_file) # other runs never see a partly written cache file
+    return df
+
+# Raw .json files can be read straight out of their .zip archives instead of being extracted first.
+# A directory lists the members it holds in ZIP_INDEX, one "<archive path>::<member name>" per line,
+# and open_source opens such a name like a file.
+# The archive paths are saved relative to the directory, so the index stays valid when the whole tree is moved.
+ZIP_INDEX = 'zip_members.txt'
+ZIP_MEMBER_SEP = '::'
+
+# Function to read the zip members listed in a directory (an empty list if it has no ZIP_INDEX)
+# The archive paths are returned joined to dirname (absolute paths saved by older runs are kept as they are).
+def read_zip_index(dirname):
+    index_file = os.path.join(dirname,ZIP_INDEX)
+    if not os.path.exists(index_file):
+        return []
+    members = []
+    with open(index_file) as f:
+        for line in f:
+            if line.strip() == '':
+                continue
+            archive,sep,member = line.rstrip('\n').rpartition(ZIP_MEMBER_SEP)
+            members.append(os.path.normpath(os.path.join(dirname,archive)) + sep + member)
+    return members
+
+# Function to add zip members to the ZIP_INDEX of a directory. Members already listed are not added again.
+def write_zip_index(dirname,names):
+    names = list(dict.fromkeys(manifest_path(name,dirname) for name in read_zip_index(dirname) + list(names)))
+    index_file = os.path.join(dirname,ZIP_INDEX)
+    temp_file = f'{index_file}.{os.getpid()}.tmp'
+    with open(temp_file,'w') as f:
+        f.writelines(name + '\n' for name in names)
+    os.replace(temp_file,index_file)
+    return index_file
+
+# Function to open a file, or a zip member named "<archive path>::<member name>", for reading in binary mode
+def open_source(name):
+    archive,sep,member = str(name).rpartition(ZIP_MEMBER_SEP)
+    if sep == '':
+        return open(name,'rb')
+    return zip_archive(archive).open(member)
+
+# The last opened archives are kept open (up to ZIP_ARCHIVES_OPEN), so the archive directory is read once and not again
+# for every member, and the least recently used one is closed when another is opened. Members that are still being read
+# keep their archive file open until they are closed.
+# They are kept per process, because an archive opened before a process pool starts would share its file position with the workers.
+ZIP_ARCHIVES_OPEN = 16
+_zip_archives = OrderedDict()
+def zip_archive(archive):
+    key = (os.path.abspath(archive),os.getpid())
+    zf = _zip_archives.pop(key,None)
+    if zf is None:
+        zf = zipfile.ZipFile(archive,'r')
+    _zip_archives[key] = zf
+    while len(_zip_archives) > ZIP_ARCHIVES_OPEN:
+        _zip_archives.popitem(last=False)[1].close()
+    return zf
+
+# Function to close the kept archives, e.g. when a stage ends in a process that goes on running other stages
+def close_zip_archives():
+    while len(_zip_archives) > 0:
+        (archive,pid),zf = _zip_archives.popitem()
+        if pid == os.getpid():
+            zf.close()
+
+# Each stage records the inputs, parameters, and outputs of its last run in a manifest in its output directory (MANIFEST),
+# and is only run again when an input file was added, removed, or changed, a parameter changed, or an output is missing.
+# Input files are compared by size and modification time, and by their content hash (sha1) when the time differs,
+# so a file that was copied or touched without changes does not cause a re-run. Zip members are compared by size and CRC.
+# Paths are saved relative to the manifest directory.
+MANIFEST = '.pipeline_manifest.json'
+
+# Function to check whether a stage was already run with these inputs and parameters, and its outputs still exist
+# When only the modification times changed (same content), the manifest is updated so the files are not hashed again next time.
+def stage_up_to_date(dirname,stage,inputs,params,outputs):
+    record = load_manifest(dirname).get(stage)
+    if record is None or record['params'] != json_params(params):
+        return False
+    if not all(os.path.exists(f) for f in outputs):
+        return False
+    inputs = [str(name) for name in inputs]
+    old_inputs = record['inputs']
+    if set(old_inputs) != set(manifest_path(name,dirname) for name in inputs):
+        return False
+    touched = False
+    for name in inputs:
+        old = old_inputs[manifest_path(name,dirname)]
+        if ZIP_MEMBER_SEP not in name and os.path.getsize(name) != old['size']:
+            return False
+        new = input_signature(name,old)
+        if new.get('sha1') != old.get('sha1') or new.get('crc') != old.get('crc') or new['size'] != old['size']:
+            return False
+        touched = touched or new != old
+    if touched:
+        save_stage(dirname,stage,inputs,params,outputs)
+    return True
+
+# Function to find the inputs added since a stage was last run
+# Returns the new inputs when the saved inputs, parameters, and outputs are all unchanged (so the outputs only miss the new inputs),
+# otherwise None.
+def stage_new_inputs(dirname,stage,inputs,params,outputs):
+    record = load_manifest(dirname).get(stage)
+    if record is None:
+        return None
+    inputs = [str(name) for name in inputs]
+    saved = [name for name in inputs if manifest_path(name,dirname) in record['inputs']]
+    if len(saved) != len(record['inputs']) or not stage_up_to_date(dirname,stage,saved,params,outputs):
+        return None
+    return [name for name in inputs if manifest_path(name,dirname) not in record['inputs']]
+
+# Function to read the extra values a stage saved with its last run (see save_stage), an empty dict if there are none
+def stage_extra(dirname,stage):
+    return load_manifest(dirname).get(stage,{}).get('extra',{})
+
+# Function to save the inputs, parameters, and outputs of a finished stage in the manifest of dirname
+# extra holds values the stage needs to continue from this run later (e.g. with new inputs); the saved ones are kept if it is None.
+def save_stage(dirname,stage,inputs,params,outputs,extra=None):
+    manifest = load_manifest(dirname)
+    old_inputs = manifest.get(stage,{}).get('inputs',{})
+    if extra is None:
+        extra = manifest.get(stage,{}).get('extra',{})
+    manifest[stage] = {'params':json_params(params),
+                       'inputs':{manifest_path(name,dirname):input_signature(name,old_inputs.get(manifest_path(name,dirname)))
+                                 for name in map(str,inputs)},
+                       'outputs':[manifest_path(str(f),dirname) for f in outputs],
+                       'extra':json_params(extra)}
+    manifest_file = os.path.join(dirname,MANIFEST)
+    temp_file = f'{manifest_file}.{os.getpid()}.tmp'
+    with open(temp_file,'w') as f:
+        json.dump(manifest,f,indent=1)
+    os.replace(temp_file,manifest_file) # a stage running at the same time never reads a partly written manifest
+    return manifest_file
+
+def load_manifest(dirname):
+    manifest_file = os.path.join(dirname,MANIFEST)
+    if not os.path.exists(manifest_file):
+        return {}
+    try:
+        with open(manifest_file) as f:
+            return json.load(f)
+    except ValueError:
+        return {} # unreadable manifest, all stages are run again
+
+# parameters as they are saved in the manifest (tuples become lists, other values that are not JSON types become strings)
+def json_params(params):
+    return json.loads(json.dumps(params,default=str))
+
+# path of a file relative to the manifest directory, so the manifest stays valid when the whole tree is moved
+# only the archive part of a zip member name ("<archive path>::<member name>") is a path
+def manifest_path(name,dirname):
+    archive,sep,member = name.rpartition(ZIP_MEMBER_SEP)
+    path = archive if sep != '' else name
+    return os.path.relpath(os.path.abspath(path),os.path.abspath(dirname)) + (sep + member if sep != '' else '')
+
+# Function to describe an input file for the manifest: size, modification time, and the sha1 of its content
+# old is the saved description of the same file; its hash is used again while size and time are unchanged, without reading the file.
+def input_signature(name,old=None):
+    archive,sep,member = name.rpartition(ZIP_MEMBER_SEP)
+    if sep != '':
+        info = zip_archive(archive).getinfo(member)
+        return {'size':info.file_size,'crc':info.CRC}
+    stat = os.stat(name)
+    signature = {'size':stat.st_size,'mtime_ns':stat.st_mtime_ns}
+    if old is not None and old.get('size') == stat.st_size and old.get('mtime_ns') == stat.st_mtime_ns:
+        signature['sha1'] = old.get('sha1')
+        return signature
+    sha1 = hashlib.sha1()
+    with open(name,'rb') as f:
+        for block in iter(lambda: f.read(1 << 20),b''):
+            sha1.update(block)
+    signature['sha1'] = sha1.hexdigest()
+    return signature
+
+# Column names in the exported .xlsx files and the kind names used in the pipeline
+EXCEL_RENAME = {'Heart rate (bpm)':'hr',
+                'Diastolic (mmHg)':'bp_dia',
+                'Systolic (mmHg)':'bp_sys',
+                'SaO2 (%)':'spo2',
+                'Body temperature (C)':'st', 
+                'Pedometer':'step',
+                'Total sleep':'sleep_total',
+                'Deep sleep':'sleep_deep',
+                'Light sleep':'sleep_light',
+                'Event Markers':'Event_markers'}
+# Parsed copies of .xlsx files are saved in this folder next to each file when load_excel is called with cache=True
+EXCEL_CACHE_DIR = '.xlsx_cache'
+
+# Function to load computed data exported to .xlsx as one table with date_time, kind, and data columns (all sheets)
+# With cache=True, the parsed table is saved next to the file on the first read, and loaded from there while the file is unchanged
+def load_excel(file_name,cache=False):
+    if cache == False:
+        return parse_excel(file_name)
+    return cached_load(parse_excel,file_name,cache_dir=os.path.join(os.path.dirname(os.path.abspath(file_name)),EXCEL_CACHE_DIR))
+
+# Function to read all sheets of a .xlsx file. The workbook is streamed in read-only mode and the sheets are joined once at the end.
+def parse_excel(file_name):
+    if load_workbook is None:
+        raise ImportError('Loading .xlsx files requires openpyxl, which is not installed.')
+    wb = load_workbook(file_name,read_only=True)
+    sheets = []
+    try:
+        for sheet in wb.worksheets:
+            rows = sheet.values
+            header = next(rows,None)
+            if header is None:
+                continue
+            header = [EXCEL_RENAME[x] if x in EXCEL_RENAME else x for x in header]
+            df = pd.DataFrame(list(rows)).reindex(columns=range(len(header)))
+            df.columns = header
+            for col in ['sleep_total','sleep_deep','sleep_light']:
+                if col in header:
+                    df[col] = to_minutes(df[col])
+            df = pd.melt(df, id_vars=['Time'], value_vars=header[1:], var_name='kind', value_name='data')
+            df = df[(df['kind'] != 'Body temperature (F)') & (df['data'] != '')]
+            sheets.append(df)
+    finally:
+        wb.close()
+    if len(sheets) == 0:
+        return pd.DataFrame({'date_time':pd.Series(dtype='datetime64[ns]'),'kind':pd.Series(dtype=object),'data':pd.Series(dtype=object)})
+    out_df = pd.concat(sheets,ignore_index=True)
+    out_df.rename(columns={'Time':'date_time'},inplace=True)
+    out_df['date_time'] = pd.to_datetime(out_df['date_time'])
+    return out_df
+
+# Function to convert durations written as "XhYm" (e.g. "7h35m") to minutes; other values (e.g. empty cells) are kept as they are
+def to_minutes(values):
+    hm = values.astype(str).str.extract(r'^(\d+)h(\d+)m$')
+    matched = hm[0].notna()
+    minutes = hm[0][matched].astype('int64')*60 + hm[1][matched].astype('int64')
+    if matched.all():
+        return minutes
+    values = values.astype(object)
+    values[matched] = minutes
+    return values
+
+# Function to convert a column of stringified lists (e.g. "[0.1, -0.2, 0.3]") to a 2-D float array in one pass
+# The list contents are joined into one block of comma separated text and parsed by the C csv reader.
+# Short lists are padded with NaN up to width (the longest list by default); longer lists are cut off at width.
+# Empty or missing entries become a row of NaN.
+def parse_list_column(strings,width=None):
+    inner = pd.Series(strings,dtype=object).fillna('').astype(str).str.strip('[] ')
+    # the csv reader drops blank lines at the end of the text, so empty entries are written as a NaN field instead
+    empty = inner == ''
+    inner = inner.where(~empty,'nan')
+    n_fields = int(inner.str.count(',').max()) + 1 if len(inner) > 0 else 0
+    if width is None:
+        width = n_fields if (~empty).any() else 0
+    if width == 0 or len(inner) == 0:
+        return np.full((len(inner),width),np.nan)
+    values = pd.read_csv(io.StringIO('\n'.join(inner.tolist())),header=None,names=range(n_fields),
+                         skip_blank_lines=False,skipinitialspace=True,na_values=['None','null'],
+                         dtype=float,float_precision='round_trip').to_numpy()
+    if width > n_fields:
+        values = np.hstack((values,np.full((len(values),width - n_fields),np.nan)))
+    return values[:,:width]
+
+# Function to stack a column of lists or arrays (as loaded from parquet/feather) to a 2-D float array, padded with NaN
+def stack_list_column(lists,width=None):
+    lists = [x if x is not None and np.ndim(x) > 0 else [] for x in lists]
+    counts = np.array([len(x) for x in lists],dtype=np.int64)
+    if width is None:
+        width = int(counts.max()) if len(counts) > 0 else 0
+    out = np.full((len(counts),width),np.nan)
+    if counts.sum() == 0:
+        return out
+    values = np.concatenate([np.asarray(x,dtype=float) for x in lists if len(x) > 0])
+    row_idx = np.repeat(np.arange(len(counts)),counts)
+    col_idx = np.arange(len(values)) - np.repeat(np.cumsum(counts) - counts,counts)
+    keep = col_idx < width
+    out[row_idx[keep],col_idx[keep]] = values[keep]
+    return out
+
+# Function to load the acceleration intermediate file (0_*_ac.csv, .parquet, or .feather)
+# The data column is returned as one float array per record, padded with NaN to the same length
+def load_ac(file_name,width=None):
+    ac = read_table(file_name)
+    if detect_format(file_name) == 'csv':
+        values = parse_list_column(ac['data'].values,width=width)
+    else:
+        values = stack_list_column(ac['data'].values,width=width)
+    ac['data'] = list(values)
+    return ac
@@ -12,114 +12,127 @@ def search_files(dirname,pattern):
     return(sorted(file_list))
 
 # data loading functions
-def load_excel(file_name):
-    out_df = pd.DataFrame(columns=['Time','kind','data'])
-    feature_rename={ 'Heart rate (bpm)':'hr',
-                    'Diastolic (mmHg)':'bp_dia',
-                    'Systolic (mmHg)':'bp_sys',
-                    'SaO2 (%)':'spo2',
-                    'Body temperature (C)':'st', 
-                    'Pedometer':'step',
-                    'Total sleep':'sleep_total',
-                    'Deep sleep':'sleep_deep',
-                    'Light sleep':'sleep_light',
-                    'Event Markers':'Event_markers'}
-    wb = load_workbook(file_name)
-    for sheet in wb.worksheets:
-        data = sheet.values
-        header = next(data)
-        header = [feature_rename[x] if x in feature_rename else x for x in header]
-        data = list(data)
-        df = pd.DataFrame(data,columns=header)
-        if 'sleep_total' in header:
-            df['sleep_total'] = df['sleep_total'].apply(lambda x: to_minutes(x) if len(x) > 0 else x)
-            df['sleep_deep'] = df['sleep_deep'].apply(lambda x: to_minutes(x) if len(x) > 0 else x)
-            df['sleep_light'] = df['sleep_light'].apply(lambda x: to_minutes(x) if len(x) > 0 else x)
-        df = pd.melt(df, id_vars=['Time'], value_vars=header[1:], var_name='kind', value_name='data')
-        df = df[df['kind'] != 'Body temperature (F)']
-        df = df[df['data'] != '']
-        out_df = pd.concat([out_df,df],ignore_index=True)
-    out_df.reset_index(inplace = True, drop = True)
-    out_df.rename(columns={'Time':'date_time'},inplace=True)
-    out_df['date_time'] = pd.to_datetime(out_df['date_time'])
-    return(out_df)
-
-def to_minutes(t):
-    hs=t.strip('m').split('h')
-    return int(hs[0])*60+int(hs[1])
-
-def load_file(file_list,suffix):
-    df = pd.DataFrame()
-    if suffix == '.csv':
-        for f in file_list:
-            msg(f'Loading {str(Path(f).parts[-1])}')
-            new_df = pd.read_csv(f)
-            new_df['date_time'] = pd.to_datetime(new_df['date_time'])
-            df = pd.concat([df,new_df], axis=0, ignore_index=True)
-    elif suffix == '.xlsx':
-        for f in file_list:
-            msg(f'Loading {str(Path(f).parts[-1])}')
-            new_df = load_excel(f)
-            df = pd.concat([df,new_df], axis=0, ignore_index=True)
-    else:
-        print('Error: Unsupported file type. .csv or .xlsx files required.')
+# load one computed data file, with the data column as float
+def load_computed(file_name):
+    if Path(file_name).suffix == '.xlsx':
+        df = load_excel(file_name)
+        df['data'] = df['data'].astype('float64')
+        return(df)
+    return(read_table(file_name,dtype={'data':'float64'}))
+
+# load all files (in a thread pool if workers > 1), then join them once
+# with cache_dir, parsed copies of the files are saved there and used again while the files are unchanged
+def load_file(file_list,suffix,workers=1,cache_dir=None):
+    if suffix not in FORMATS.values() and suffix != '.xlsx':
+        print('Error: Unsupported file type. .csv, .parquet, .feather, or .xlsx files required.')
         sys.exit(2)
+    load = partial(cached_load,load_computed,cache_dir=cache_dir)
+    if workers > 1 and len(file_list) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            frames = list(pool.map(load,file_list))
+    else:
+        frames = [load(f) for f in file_list]
+    for f in file_list:
+        msg(f'Loaded {str(Path(f).parts[-1])}')
+    df = pd.concat(frames, axis=0, ignore_index=True)
     df.sort_values(by=['kind', 'date_time'], inplace=True) 
-    df['data'] = df['data'].apply(lambda x: float(x))
     df.reset_index(drop=True, inplace=True)
     msg(f'All done. {str(len(file_list))} file(s) loaded.')
     return(df)
 
-# separate measurements into different dataframes
-# if replace == True, then the filtered subset will be merged back to the input dataframe, replacing the original subset
-def subset_df(df, kind, min_val=0, max_val=1000000, keep_na=False, replace = False):
-    new_df = df[df['kind']==kind]
-    if keep_na == False:
-        new_df = new_df[((new_df['data']<=max_val) & (new_df['data']>=min_val))]
-    else:
-        new_df = new_df[((new_df['data']<=max_val) & (new_df['data']>=min_val)) | np.isnan(new_df['data'])]
-    if replace == True:
-        df1 = df[df['kind']!=kind]
-        new_df = pd.concat([df1,new_df])
-    new_df.reset_index(drop=True,inplace=True)
-    return(new_df)
+# value range of each kind: records outside [min, max] are removed, and missing values are removed unless keep_na is True
+# kinds that are not listed are not filtered
+THRESHOLDS = {'hr':     {'min':50, 'max':1000000, 'keep_na':False},
+              'bp_dia': {'min':60, 'max':1000000, 'keep_na':False},
+              'bp_sys': {'min':80, 'max':1000000, 'keep_na':False},
+              'spo2':   {'min':80, 'max':1000000, 'keep_na':False},
+              'st':     {'min':30, 'max':1000000, 'keep_na':False}}
+
+# load a threshold table from a .csv file with the columns kind, min, max, keep_na (one row per kind)
+# empty min, max, or keep_na use the defaults 0, 1000000, and False
+def load_thresholds(file_name):
+    table = pd.read_csv(file_name,dtype={'kind':str})
+    if 'kind' not in table.columns:
+        sys.exit(f'Error: Threshold file {file_name} needs a "kind" column.')
+    thresholds = {}
+    for row in table.to_dict('records'):
+        keep_na = row.get('keep_na',False)
+        thresholds[row['kind']] = {'min':float(row['min']) if pd.notna(row.get('min',np.nan)) else 0,
+                                   'max':float(row['max']) if pd.notna(row.get('max',np.nan)) else 1000000,
+                                   'keep_na':str(keep_na).strip().lower() in ['true','1','yes'] if pd.notna(keep_na) else False}
+    return(thresholds)
+
+# filter all kinds in one pass: the kind of each record is mapped to its limits, and all records are checked with one mask
+def range_filter(df, thresholds=THRESHOLDS):
+    kinds = pd.Index(list(thresholds))
+    codes = kinds.get_indexer(df['kind']) # -1 for kinds that are not listed, which picks the last (no limit) entry
+    min_val = np.array([thresholds[k]['min'] for k in kinds] + [-np.inf],dtype=float)[codes]
+    max_val = np.array([thresholds[k]['max'] for k in kinds] + [np.inf],dtype=float)[codes]
+    keep_na = np.array([thresholds[k]['keep_na'] for k in kinds] + [True],dtype=bool)[codes]
+    values = df['data'].to_numpy(dtype=float)
+    keep = ((values >= min_val) & (values <= max_val)) | (keep_na & np.isnan(values))
+    msg(f'{np.count_nonzero(~keep)} records outside the value range of their kind removed.')
+    return(df[keep].reset_index(drop=True))
 
 # filtering function. used on heart rate data to detect periods with abnormal recording (same number recorded for a long period of time)
-def t_incl(df):
-    df1 = df.copy()
-    df1.reset_index(drop=True, inplace=True) # making sure indices of input dataframe is in order
-    x = list(df1['data'])
-    # itertools.groupby creates a generator object. 
-    # When used on numerical list, each element consists of the name of repeating data (p here, same as the data value) and all instances of repeat (q here)
-    # len(list(q)) expands q and count the length, i.e. the number of times p repeats in a row
-    grouped_x = [(p, len(list(q))) for p,q in groupby(x)] 
-    start = 0
-    end = 0
-    incl_time = list()
-    for i,j in grouped_x:
-        if j <= 20: # normal cases (extremely rare to see any normal recording to have any identical number repeating 20+ time in a row)
-            end += j
-            if end == len(x): # reaching the end of the list
-                incl_time.append((df1['date_time'][start],df1['date_time'][end-1],1))
-        else: # abnormal cases
-            if end > start: # if there are previous normal records, record the previous interval first, then reset start to current value of end
-                incl_time.append((df1['date_time'][start],df1['date_time'][end-1],1))
-                start = end
-            end += j
-            incl_time.append((df1['date_time'][start],df1['date_time'][end-1],0)) # record abnormal interval (marked by 0 at the end)
-            start = end
-    return(incl_time)
-
-# filter based on include/exclude time intervals established by t_incl()
-def df_filter(df,t_intervals):
+# it is extremely rare to see any normal recording to have any identical number repeating more than max_repeats (20) times in a row
+# returns the intervals as three arrays: start time, end time, and 1 for normal / 0 for abnormal intervals
+# runs of abnormal values are one interval each; the normal values between them are merged into one interval
+def t_incl(df, max_repeats=20):
+    times = df['date_time'].to_numpy()
+    run_starts, run_lengths = value_runs(df['data'].to_numpy())
+    stuck = run_lengths > max_repeats
+    # a new interval starts at each abnormal run, and at the first normal run after it
+    new_interval = stuck.copy()
+    new_interval[1:] |= stuck[:-1]
+    new_interval[:1] = True
+    first = run_starts[new_interval]
+    last = np.append(first,len(times))[1:] - 1
+    return(times[first],times[last],np.where(stuck[new_interval],0,1))
+
+# run-length encoding: start index and length of each run of identical consecutive values (NaN values are never identical)
+def value_runs(x):
+    x = np.asarray(x)
+    run_starts = np.flatnonzero(np.concatenate(([len(x) > 0],x[1:] != x[:-1])))
+    run_lengths = np.diff(np.append(run_starts,len(x)))
+    return(run_starts,run_lengths)
+
+# remove the records of each kind in kinds that are part of a run of more than max_repeats identical values
+# unlike the hr check, only the records of that kind are removed. 'bp' stands for both bp_sys and bp_dia
+def drop_stuck(df, kinds, max_repeats=20):
+    kinds = [k for kind in kinds for k in (['bp_sys','bp_dia'] if kind == 'bp' else [kind])]
+    drop = np.zeros(len(df),dtype=bool)
+    kind_col, times, values = df['kind'].to_numpy(), df['date_time'].to_numpy(), df['data'].to_numpy()
+    for kind in kinds:
+        rows = np.flatnonzero(kind_col == kind)
+        rows = rows[np.argsort(times[rows],kind='stable')]
+        run_starts, run_lengths = value_runs(values[rows])
+        drop[rows] = np.repeat(run_lengths > max_repeats,run_lengths)
+        msg(f'{kind}: {np.count_nonzero(drop[rows])} records in runs of more than {max_repeats} identical values removed.')
+    return(df[~drop].reset_index(drop=True))
+
+# filter based on include/exclude time intervals established by t_incl() (arrays of start time, end time, and include flag)
+# the include intervals are sorted once; each row is matched to the last include interval starting at or before it (np.searchsorted),
+# and kept if it is not after the end of that interval (start and end are both included). Overlapping intervals are merged.
+# log_discarded prints the excluded intervals in verbose mode
+def df_filter(df,t_intervals,log_discarded=True):
     msg(f'Total rows in input dataframe: {len(df)}')
-    new_df = pd.DataFrame()
-    for start,end,include in t_intervals:
-        if include == 1:
-            df_sub = df[(df['date_time'] >= start) & (df['date_time'] <= end)]
-            new_df = pd.concat([new_df,df_sub],ignore_index=True)
-        else:
-            msg(f'    - Data between {start} and {end} discarded.')
+    starts,ends,include = (np.asarray(x) for x in t_intervals)
+    if log_discarded == True:
+        for start,end in zip(starts[include != 1],ends[include != 1]):
+            msg(f'    - Data between {pd.Timestamp(start)} and {pd.Timestamp(end)} discarded.')
+    times = df['date_time'].to_numpy()
+    if np.count_nonzero(include == 1) == 0:
+        keep = np.zeros(len(df),dtype=bool)
+    else:
+        starts = pd.to_datetime(starts[include == 1]).to_numpy()
+        ends = pd.to_datetime(ends[include == 1]).to_numpy()
+        order = np.argsort(starts,kind='stable')
+        starts = starts[order]
+        ends = np.maximum.accumulate(ends[order]) # latest end of the intervals starting at or before each start
+        idx = np.searchsorted(starts,times,side='right') - 1
+        keep = (idx >= 0) & (times <= ends[np.maximum(idx,0)])
+    new_df = df[keep].reset_index(drop=True)
     msg(f'Done. Total rows in filtered dataframe: {len(new_df)}')
     return(new_df)
 
@@ -130,20 +143,29 @@ def main():
     Usage: python filtering_data.py -f/-d <input_files/directory> -s save_name [options]
 
     Arguments:
-        -f: input file, .xlsx or .csv
+        -f: input file, .xlsx, .csv, .parquet, or .feather
         -d: directory containing multiple data files, reads all .xlsx files by default (use -p to modify search pattern)
-        -s: save file name (.csv)
+        -s: save file name (.csv, .parquet, or .feather). The output format follows the file extension.
 
     Options:
         -h or --help: print help document
         -p: search pattern for -d (default '*.xlsx')
             If pattern include wild card characters (* or ?), use quotation marks around the pattern
+        --format: output file format (parquet, feather, or csv), replaces the file extension given in -s
+        --max-repeats: number of identical values in a row above which a recording is abnormal (default 20)
+            Periods where hr repeats more often are removed for all kinds.
+        -j: number of files to load at the same time (default 1)
+        --cache: directory for parsed copies of the input files (including .xlsx); unchanged files are loaded from there on later runs
+        -t: threshold table (.csv) with the columns kind, min, max, keep_na, replacing the default value ranges
+            (hr >= 50, bp_dia >= 60, bp_sys >= 80, spo2 >= 80, st >= 30). Kinds that are not listed are not filtered.
+        --stuck-kinds: other kinds to check for repeated values, separated by commas (e.g. spo2,st,bp)
+            Only the repeated records of these kinds are removed. bp checks both bp_sys and bp_dia.
         -v: verbose mode
     '''
     # read arguments from command line and parse options
     arg_list = sys.argv[1:]
-    short_opts = 'f:d:p:s:hv'
-    long_opts = ['help']
+    short_opts = 'f:d:p:s:t:j:hv'
+    long_opts = ['help','format=','max-repeats=','stuck-kinds=','cache=']
     global verbose
     verbose = False
     try:
@@ -168,6 +190,12 @@ def main():
     # initialize variables and process arguments
     dir_name,file_list,file_type,save_file = '','','',''
     search_pattern = '*.xlsx'
+    file_format = None
+    max_repeats = 20
+    stuck_kinds = []
+    thresholds = THRESHOLDS
+    workers = 1
+    cache_dir = None
     for current_arg, current_val in opt_list:
         if current_arg == '-f':
             file_name = current_val
@@ -179,11 +207,46 @@ def main():
             msg(f'Search pattern changed to "{search_pattern}"')
         elif current_arg == '-s':
             save_file = current_val
+        elif current_arg == '--format':
+            file_format = current_val
+            format_err = check_format(file_format)
+            if format_err != '':
+                sys.exit(format_err)
+        elif current_arg == '-t':
+            if not os.path.isfile(current_val):
+                sys.exit(f'Error: Threshold file {current_val} does not exist.')
+            thresholds = load_thresholds(current_val)
+            msg(f'Value ranges loaded from {current_val}')
+        elif current_arg == '-j':
+            try:
+                workers = int(current_val)
+            except ValueError:
+                sys.exit(f'Error: Invalid number of files: {current_val}')
+        elif current_arg == '--cache':
+            cache_dir = current_val
+            msg(f'Cache directory: {cache_dir}')
+        elif current_arg == '--max-repeats':
+            try:
+                max_repeats = int(current_val)
+            except ValueError:
+                sys.exit(f'Error: Invalid number of repeats: {current_val}')
+            msg(f'Maximum number of repeats set to {max_repeats}')
+        elif current_arg == '--stuck-kinds':
+            stuck_kinds = [k.strip() for k in current_val.split(',') if k.strip() != '']
+            msg(f'Checking repeated values in: {", ".join(stuck_kinds)}')
     
     if save_file == '':
         print('Output file name or directory not provided (-s)')
         sys.exit()
     
+    # output format follows the extension of the save file name unless --format is used
+    save_stem, save_ext = os.path.splitext(save_file)
+    if file_format is None:
+        save_formats = [k for k,v in FORMATS.items() if v == save_ext]
+        file_format = save_formats[0] if len(save_formats) > 0 else DEFAULT_FORMAT
+    if save_ext not in FORMATS.values():
+        save_stem = save_file
+    
     if dir_name != '':
         file_list = search_files(dir_name,search_pattern)
     if len(file_list) == 0:
@@ -199,25 +262,26 @@ def main():
                 sys.exit(f'Error: With the current search pattern ({search_pattern}), there are more than one type of file in the input list ({file_type} and {Path(f).suffix}).')
         msg(f'Loading file type: {file_type}')
 
-    hr_min = 50
-    bp_dia_min, bp_sys_min = 60, 80
-    spo2_min = 80
-    st_min = 30
-
+    # skip if the output was made from the same files with the same options (see data_io.stage_up_to_date)
+    save_dir, stage = Path(save_stem).parent, 'filtering_data:' + Path(save_stem).name
+    params = {'thresholds':thresholds,'max_repeats':max_repeats,'stuck_kinds':stuck_kinds,'format':file_format}
+    if stage_up_to_date(save_dir, stage, file_list, params, [save_stem + FORMATS[file_format]]):
+        print(f'{save_stem + FORMATS[file_format]} is up to date, skipping.')
+        return
 
     # load computed data
-    computed_df = load_file(file_list,file_type)
+    computed_df = load_file(file_list,file_type,workers=workers,cache_dir=cache_dir)
     # extract hr to detect abnormal measurements
     hr_df = computed_df[computed_df['kind']=='hr'].copy()
-    t1 = t_incl(hr_df)
+    t1 = t_incl(hr_df, max_repeats=max_repeats)
     computed_df_filt = df_filter(computed_df,t1)
-    computed_df_filt = subset_df(computed_df_filt, 'hr', min_val=hr_min,replace=True)
-    computed_df_filt = subset_df(computed_df_filt, 'bp_dia', min_val=bp_dia_min,replace=True)
-    computed_df_filt = subset_df(computed_df_filt, 'bp_sys', min_val=bp_sys_min,replace=True)
-    computed_df_filt = subset_df(computed_df_filt, 'spo2', min_val=spo2_min,replace=True)
-    computed_df_filt = subset_df(computed_df_filt, 'st', min_val=st_min,replace=True)
+    if len(stuck_kinds) > 0:
+        computed_df_filt = drop_stuck(computed_df_filt, stuck_kinds, max_repeats=max_repeats)
+    computed_df_filt = range_filter(computed_df_filt, thresholds)
     computed_df_filt.sort_values(by=['kind','date_time'],inplace=True)
-    computed_df_filt.to_csv(save_file,index = False)
+    save_file = write_table(computed_df_filt, save_stem, file_format=file_format)
+    save_stage(save_dir, stage, file_list, params, [save_file])
+    msg(f'Saved to {save_file}')
     return
 
 if __name__ == '__main__':
@@ -225,8 +289,9 @@ if __name__ == '__main__':
     import pandas as pd
     from pathlib import Path
     import numpy as np
-    from itertools import groupby
-    from openpyxl import load_workbook
+    from functools import partial
+    from concurrent.futures import ThreadPoolExecutor
+    from data_io import read_table, write_table, load_excel, cached_load, check_format, stage_up_to_date, save_stage, FORMATS, DEFAULT_FORMAT
     main()
     
     
@@ -19,6 +19,36 @@ def extract_zip(archive,dst):
     for f,n in file_type_summary:
         msg(f'\t{n} {f} files.')
 
+# group the .json members of zip archives by the date in their names, without extracting them
+# only the archive directories are read. Returns {date: ["<archive path>::<member name>", ...]}
+def zip_members_by_date(zip_list):
+    from data_io import ZIP_MEMBER_SEP # data_io loads pandas, only imported for -z
+    members = {}
+    for archive in zip_list:
+        try:
+            with zipfile.ZipFile(archive,'r') as zf:
+                names = [m for m in zf.namelist() if m.endswith('.json')]
+        except Exception as err:
+            print(err)
+            continue
+        msg(f'{archive}: {len(names)} .json files.')
+        for m in names:
+            f_date = re.findall(r'\d{4}-\d{2}-\d{2}',Path(m).name)
+            if len(f_date) == 0:
+                msg(f'No date found in {m}, skipping.')
+                continue
+            members.setdefault(f_date[0],[]).append(str(archive) + ZIP_MEMBER_SEP + m)
+    return(members)
+
+# list the zip members of each date in the output folder of that date (ZIP_INDEX), for raw_data_reformat.py to read from the archives
+# the archive paths are saved relative to that folder, so the folders can be moved together with the archives
+def index_members(members,name_stem):
+    from data_io import write_zip_index
+    make_dirs(list(members),name_stem)
+    for d,names in members.items():
+        index_file = write_zip_index(name_stem + '_' + d,names)
+        msg(f'Listed {len(names)} files in {index_file}')
+
 # find the longest string that is a part of every file name
 def auto_stem_detect(computed_file_dir : str, file_ext = 'xlsx'):
     search_pat = str(Path(computed_file_dir)) + '/*' + file_ext
@@ -40,24 +70,51 @@ def auto_stem_detect(computed_file_dir : str, file_ext = 'xlsx'):
             print(err)
             return(None)
 
-def make_dirs(file_list,name_stem):
-    date_list = list(set([re.findall('\d{4}-\d{2}-\d{2}',f)[0] for f in file_list]))
-    for d in date_list:
-        msg(f'Making directory for date: {d}')
+# extract the archives into dst, workers archives at a time
+# zipfile releases the GIL while it decompresses and writes, so threads are enough to keep several archives going
+def extract_all(zip_list,dst,workers = 1):
+    if workers > 1 and len(zip_list) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(partial(extract_zip,dst=dst),zip_list))
+    else:
+        for f in zip_list:
+            extract_zip(f,dst)
+
+# group the files by the date in their names, found once for each file. Returns {date: [files]}
+def group_by_date(file_list):
+    date_pattern = re.compile(r'\d{4}-\d{2}-\d{2}')
+    file_groups = {}
+    for f in file_list:
+        f_date = date_pattern.search(Path(f).name)
+        if f_date is None:
+            print(f'No date found in {f}, skipping.')
+            continue
+        file_groups.setdefault(f_date.group(0),[]).append(f)
+    return(file_groups)
+
+# make one directory for each date
+def make_dirs(date_list,name_stem):
+    for d in sorted(date_list):
         dir_name = name_stem + '_' + d
         if Path(dir_name).exists():
-            msg(f'{dir_name} already exist. Moving on to the next date.')
+            msg(f'{dir_name} already exist.')
             continue
-        os.mkdir(dir_name)
+        os.makedirs(dir_name,exist_ok=True)
         msg(f'Created directory: {dir_name}')
     return
 
-def sort_files(file_list,name_stem):
-    for f in file_list:
-        f_date = re.findall('\d{4}-\d{2}-\d{2}',f)[0]
-        dst_dir = name_stem + '_' + f_date
-        shutil.move(f,dst_dir)
-        msg(f'Moved {f} to {dst_dir}')
+# move the files of each date into the directory of that date
+# Within one file system the files are renamed with os.replace, otherwise they are copied by shutil.move.
+def sort_files(file_groups,name_stem):
+    for d,files in sorted(file_groups.items()):
+        dst_dir = name_stem + '_' + d
+        if os.stat(Path(files[0]).parent).st_dev == os.stat(dst_dir).st_dev:
+            move = os.replace
+        else:
+            move = shutil.move
+        for f in files:
+            move(f,os.path.join(dst_dir,Path(f).name))
+        msg(f'Moved {len(files)} files to {dst_dir}')
     
 
 def main():
@@ -75,6 +132,9 @@ def main():
     Options:
         -h or --help: print help document
         -j: Process .json files instead of .zip files (the default format). 
+        -w: number of zip files to extract at the same time (default 1)
+        -z: Do not extract the .zip files. The .json files in them are listed in each date folder (in zip_members.txt)
+            and raw_data_reformat.py reads them straight from the archives, so the archives must be kept.
         -c: Modifies -o behavior to automatically find name stem according to matching computed data file names.
             Looks for .xlsx files in the provided folder instead of taking the argument as name stem
             e.g., "-o Computed/ -c" will find the name stem used in .xlsx files in the "Computed/" folder.
@@ -82,7 +142,7 @@ def main():
         -v: Verbose mode
     '''
     arg_list = sys.argv[1:]
-    short_opts = 'd:o:cjhv'
+    short_opts = 'd:o:w:cjzhv'
     long_opts = ['help']
     global verbose
     verbose = False
@@ -101,6 +161,8 @@ def main():
     
     # Initialize variables
     file_format = 'zip'
+    in_archive = False
+    workers = 1
     auto_stem = False
     src_dir, output_stem = None, None
     zip_list = None
@@ -115,6 +177,13 @@ def main():
             auto_stem = True
         if current_arg == '-j':
             file_format = 'json'
+        if current_arg == '-z':
+            in_archive = True
+        if current_arg == '-w':
+            try:
+                workers = int(current_val)
+            except ValueError:
+                sys.exit(f'Invalid number of workers: {current_val}')
             
     if src_dir is None or output_stem is None:
         sys.exit('Missing -d or -o arguments, exiting.')
@@ -127,22 +196,28 @@ def main():
         if not Path(output_stem).parent.is_dir():
             sys.exit(f'Invalid path: {Path(output_stem).parent}')
     
+    # list the files in the zip archives by date, without extracting them
+    if file_format == 'zip' and in_archive:
+        zip_list = glob.glob(str(Path(src_dir)) + '/*.zip')
+        index_members(zip_members_by_date(zip_list), output_stem)
+        print('All files sorted. The zip files are read by raw_data_reformat.py, keep them in place.')
+        sys.exit(0)
+    
     # unzip all files
     if file_format == 'zip':
         search_pat = str(Path(src_dir)) + '/*.zip'
         zip_list = glob.glob(search_pat)
-        for f in zip_list:
-            extract_zip(f, src_dir)
+        extract_all(zip_list, src_dir, workers=workers)
     
-    # find all .json files
+    # find all .json files and their dates
     search_pat = str(Path(src_dir)) + '/*.json'
-    file_list = glob.glob(search_pat)
+    file_groups = group_by_date(glob.glob(search_pat))
     
     # create output directories
-    make_dirs(file_list, output_stem)
+    make_dirs(list(file_groups), output_stem)
     
-    # sort files in file_list into output directories
-    sort_files(file_list, output_stem)
+    # sort files into output directories
+    sort_files(file_groups, output_stem)
     
     if zip_list is None:
         print('All files sorted.')
@@ -166,4 +241,6 @@ if __name__ == '__main__':
     import zipfile,shutil
     from pathlib import Path
     from itertools import groupby
+    from functools import partial
+    from concurrent.futures import ThreadPoolExecutor
     main()
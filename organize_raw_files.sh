@@ -1,5 +1,6 @@
 #!/bin/bash
 # organizing all .json files into folders by date
+# Superseded by organize_raw_files.py, which this script now calls to sort the files (instead of running grep and mv for every file).
 # This script assumes that all input files are from the same subject
 # Execute the script in the folder containing all .json files. 
 # Requires subject number as an input for proper naming of the folders. e.g. "sh organize_raw_file.sh -s 23", where 23 is the subject number.
@@ -60,56 +61,18 @@ then
     exit 2
 fi
 
-cd $work_dir
 if [[ "$verbose" == 1 ]]
 then 
-    echo "Current directory: "$(pwd)
+    v_opt="-v"
 fi
 
 full_pref=$(echo $prefix$subject"_") # define the directory prefix
 
-# Report total files to be processed
-files=(*.json)
-N=${#files[@]}
+# Find the device ID once, from the first .json file (all files are from the same subject)
+files=("$work_dir"/*.json)
+echo "Total .json files: "${#files[@]}
+device=$(grep -o -E '(\w{2}-){5}\w{2}' <<< "$(basename "${files[0]}")")
 unset files
-echo "Total .json files: "$N
-
-# Set up counter
-n=0
-
-# Start looping through .json files
-
-for i in *.json
-do
-    # Find and extract the sub-string that contains the unique identifier sequence and the date
-    # prefix is added to the front to complete the directory name
-    id=$(grep -o -E '(\w{2}-){5}\w{2}_\d{4}(-\d{2}){2}' <<< $i)
-    dir=$full_pref$id 
-    
-    # Create directory if not already existsing
-    if [ ! -d $dir ]
-    then
-        mkdir $dir
-        if [[ "$verbose" == 1 ]]
-        then
-            echo "New directory: "$dir
-        fi
-    fi
-
-    # move current file into the directory
-    mv "$i" $dir/
-    
-    # report progress 
-    n=$((n+1))
-    if [ $((n % 100)) -eq 0 ] 
-    then
-        if [[ "$verbose" == 1 ]]
-        then
-            echo $n" / "$N" files moved"
-        fi
-    fi
-done
-
-echo "Finished. Total files moved: "$n
-
 
+# Folders are named like before, e.g. "0729stanford23_E0-77-5D-CB-FF-18_2022-01-26"
+python "$(dirname "$0")/organize_raw_files.py" -j -d "$work_dir" -o "$work_dir/$full_pref$device" $v_opt
@@ -1,3 +1,17 @@
+import sys, os, getopt, glob,re, json, time, shutil, tempfile
+from pathlib import Path
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import chain
+import pandas as pd
+import numpy as np
+from data_io import read_table, write_table, write_table_parts, load_excel, check_format, open_source, read_zip_index, stage_up_to_date, stage_new_inputs, stage_extra, save_stage, FORMATS, DEFAULT_FORMAT, ZIP_INDEX, ZIP_MEMBER_SEP
+try:
+    import orjson # faster json parser, optional
+except ImportError:
+    orjson = None
+
 ### recursive search for all files within the given master folder that fits a pattern
 def search_files(dirname,pattern,recursive = False):
     print(f'Searching files with the pattern "{pattern}"...')
@@ -8,63 +22,171 @@ def search_files(dirname,pattern,recursive = False):
     file_list = glob.glob(search_str,recursive=recursive)
     return(sorted(file_list))
 
+# all .json files in the directory, and the .json members of zip archives listed in its ZIP_INDEX (see organize_raw_files.py -z)
+# the members are read from the archives directly, and are sorted with the files as if they were extracted into the directory
+def search_json(dirname,recursive = False):
+    file_list = search_files(dirname,'.json',recursive=recursive)
+    if recursive == True:
+        index_dirs = [os.path.dirname(f) for f in glob.glob(os.path.abspath(dirname) + '/**/' + ZIP_INDEX,recursive=True)]
+    else:
+        index_dirs = [os.path.abspath(dirname)]
+    members = {}
+    for index_dir in index_dirs:
+        for name in read_zip_index(index_dir):
+            members[os.path.join(index_dir,os.path.basename(name.rpartition(ZIP_MEMBER_SEP)[2]))] = name
+    if len(members) == 0:
+        return(file_list)
+    print(f'Reading {len(members)} .json files from zip archives.')
+    sources = dict(zip(file_list,file_list))
+    sources.update({path:name for path,name in members.items() if path not in sources}) # extracted copies are read instead
+    return([sources[path] for path in sorted(sources)])
+
 # timestamp_diff will take precedence over ref_time
 # File refference pattern searches for the full timestamp within the file name (i.e. ####-##-## ##-##-##), can be edited
-def load_json(dirname, timestamp_diff=None, ref_time=None, file_ref_pattern='\d\d\d\d-\d\d-\d\d\s\d\d-\d\d-\d\d', verbose=False, recursive=False): 
-    jdata=pd.DataFrame()
+# All files are parsed to plain columns first and the dataframe is built once at the end.
+# orjson is used for parsing when it is installed, unless fast_json is False.
+# With workers > 1, files are parsed in a process pool; results are merged in file name order.
+def load_json(dirname, timestamp_diff=None, ref_time=None, file_ref_pattern=r'\d\d\d\d-\d\d-\d\d\s\d\d-\d\d-\d\d', verbose=False, recursive=False, fast_json=True, workers=1, tz=None): 
     if dirname==None:
         print('Error: Missing directory name.')
         sys.exit(2)
-    file_list = search_files(dirname,'.json',recursive=recursive)
-    for filename in file_list:
+    file_list = search_json(dirname,recursive=recursive)
+    if workers > 1 and len(file_list) > 1:
         if verbose == True:
-            print(f'Loading file: {filename}')
-        j_id=re.search(file_ref_pattern,filename) # this is the time in the file name
-        if j_id == None:
-            print(f'Could not find timestamp pattern ({file_ref_pattern}) in file name: {filename}')
-            j_id = ''
-        else:
-            j_id = j_id.group(0)
-        j = pd.read_json(filename)
-        j['jname'] = j_id
-        jdata=pd.concat([jdata,j],ignore_index=True)
+            print(f'Parsing {len(file_list)} files with {workers} workers')
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            jdata=load_json_files(file_list, file_ref_pattern, verbose=verbose, fast_json=fast_json, pool=pool, workers=workers)
+    else:
+        jdata=load_json_files(file_list, file_ref_pattern, verbose=verbose, fast_json=fast_json)
     if verbose == True:
         print('All data loaded')    
-    jdata=adjust_time(jdata, d_time=timestamp_diff,excel_time=ref_time,dirname=dirname)
-    jdata=convert_date_time(jdata)
+    jdata=adjust_time(jdata, d_time=timestamp_diff,excel_time=ref_time)
+    jdata=convert_date_time(jdata, tz=tz)
     jdata.sort_values(by=['kind', 'date_time'], inplace=True)
     
     return(jdata)
 
-def adjust_time(df, excel_time, d_time, dirname):
-    if excel_time==None and d_time==None:
-        df['adj_time'] = df['time'].apply(lambda x: x)
-    elif d_time!=None:
-        df['adj_time'] = df['time'].apply(lambda x: int(x + d_time))
+# parse a list of .json files and build one dataframe with the records in file order, tagged with jname
+def load_json_files(file_list, file_ref_pattern, verbose=False, fast_json=True, pool=None, workers=1):
+    chunks = parse_json_files(file_list, fast_json=fast_json, pool=pool, workers=workers)
+    if verbose == True:
+        for filename, (columns, n, elapsed) in zip(file_list, chunks):
+            print(f'Loaded file: {filename} ({n} records, {elapsed:.3f} s)')
+    n_records = [n for columns, n, elapsed in chunks]
+    jdata=pd.DataFrame(merge_json_columns([columns for columns, n, elapsed in chunks], n_records))
+    del chunks
+    jdata['jname'] = np.repeat(json_ids(file_list, file_ref_pattern), n_records)
+    return(jdata)
+
+# parse .json files to columns, in the process pool if one is given
+def parse_json_files(file_list, fast_json=True, pool=None, workers=1):
+    parse = partial(read_json_columns, fast_json=fast_json)
+    if pool is not None and len(file_list) > 1:
+        return(list(pool.map(parse, file_list, chunksize=max(1, len(file_list)//(workers*4)))))
+    return([parse(filename) for filename in file_list])
+
+# parse one .json file (or zip member, see search_json) to a list of records
+def read_json_records(filename, fast_json=True):
+    with open_source(filename) as f:
+        if fast_json and orjson is not None:
+            return(orjson.loads(f.read()))
+        return(json.load(f))
+
+# parse one .json file to columns: numpy arrays for scalar fields (kind, time) and plain lists for list fields (data)
+# this is the unit of work for the process pool, so only compact columns are sent back to the main process
+def read_json_columns(filename, fast_json=True):
+    t_start = time.perf_counter()
+    records = read_json_records(filename, fast_json=fast_json)
+    columns = {}
+    for key in dict.fromkeys(k for r in records for k in r):
+        values = [r.get(key) for r in records]
+        if any(isinstance(v, (list, dict)) for v in values):
+            columns[key] = values
+        else:
+            columns[key] = np.array(values)
+    return(columns, len(records), time.perf_counter() - t_start)
+
+# join the columns parsed from each file, in the order of the files
+def merge_json_columns(chunks, n_records):
+    merged = {}
+    for key in dict.fromkeys(k for c in chunks for k in c):
+        parts = [c[key] if key in c else [None]*n for c, n in zip(chunks, n_records)]
+        if any(isinstance(p, list) for p in parts):
+            merged[key] = list(chain.from_iterable(parts))
+        else:
+            merged[key] = np.concatenate(parts)
+    return(merged)
+
+# find the timestamp in each file name (this is the time in the file name), used to tag the records from each file
+def json_ids(file_list, file_ref_pattern):
+    j_ids = []
+    for filename in file_list:
+        j_id=re.search(file_ref_pattern,filename.rpartition(ZIP_MEMBER_SEP)[2])
+        if j_id == None:
+            print(f'Could not find timestamp pattern ({file_ref_pattern}) in file name: {filename}')
+            j_ids.append('')
+        else:
+            j_ids.append(j_id.group(0))
+    return(np.array(j_ids, dtype=object))
+
+def adjust_time(df, excel_time, d_time):
+    if d_time!=None:
         print('Using d_time.')
+    elif excel_time!=None:
+        d_time = excel_time_diff(excel_time, min(df['time']))
+    # first json time and the timestamp difference, saved with the outputs for --append
+    df.attrs['json_time'] = int(df['time'].min()) if len(df) > 0 else None
+    df.attrs['d_time'] = None if d_time==None else int(d_time)
+    df = shift_time(df, d_time)
+    return(df)
+
+# add the timestamp difference (milliseconds, None for no change) to the json time
+def shift_time(df, d_time):
+    if d_time==None:
+        df['adj_time'] = df['time'].astype('int64')
     else:
-        json_time = min(df['time'])
-        d_time = round((excel_time*1000 - json_time)/900000)*900000
-        # excel timestamp is second precision, json timestamp is millisecond precision
-        df['adj_time'] = df['time'].apply(lambda x: int(x + d_time))
-        print('Using excel_time')
-    # saving d_time for future use
-    dirname=Path(dirname)
-    filename=str(dirname.parent.parent) + '/timestamp_diff.txt'
-    with open(filename,'w') as f:
-        f.write(str(d_time))
+        df['adj_time'] = (df['time'] + d_time).astype('int64')
     return(df)
 
-def convert_date_time(df):
-    local_format='%Y-%m-%d %H:%M:%S.%f' # including the milliseconds in the time
-    df['date_time']=pd.to_datetime(df['adj_time'].apply(lambda x: 
-                                                        datetime.fromtimestamp(x/1000).strftime(local_format)))
+# timestamp difference between the first computed data record (excel_time, in seconds) and the first json record (json_time, in milliseconds)
+def excel_time_diff(excel_time, json_time):
+    # excel timestamp is second precision, json timestamp is millisecond precision
+    d_time = round((excel_time*1000 - json_time)/900000)*900000
+    print('Using excel_time')
+    return(d_time)
+
+# save the timestamp difference for future use (-t), by default in timestamp_diff.txt two folders above the json directory
+# days processed at the same time may save to the same file, so it is replaced in one step and never read half written
+def save_time_diff(d_time, filename):
+    temp_file=f'{filename}.{os.getpid()}.tmp'
+    with open(temp_file,'w') as f:
+        f.write(str(d_time))
+    os.replace(temp_file, filename)
+
+def time_diff_file(dirname):
+    return(str(Path(dirname).parent.parent) + '/timestamp_diff.txt')
+
+# convert the millisecond epoch time to naive date_time in local time (including the milliseconds)
+# tz=None uses the time zone of this computer, otherwise a time zone name, e.g. 'America/Los_Angeles'
+def convert_date_time(df, tz=None):
+    adj_time = df['adj_time'].to_numpy(dtype='int64')
+    if tz is None:
+        df['date_time']=pd.to_datetime(adj_time + local_offsets(adj_time), unit='ms')
+    else:
+        df['date_time']=pd.to_datetime(adj_time, unit='ms', utc=True).tz_convert(tz).tz_localize(None)
     df.drop(['time','adj_time'],axis = 1,inplace=True)
-    df['date']=df['date_time'].apply(lambda x: x.date())
-    df['time']=df['date_time'].apply(lambda x: x.time())
+    df['date']=df['date_time'].dt.date
+    df['time']=df['date_time'].dt.time
     return(df)
 
-def json_data_cleanup(df, save_as_csv=False, dirname=None, verbose=False):
+# UTC offset (in milliseconds) of the local time zone for each epoch time
+# offsets only change on 15 minute boundaries, so they are looked up once per 15 minute block instead of once per record
+def local_offsets(epoch_ms):
+    codes, blocks = pd.factorize(epoch_ms // 900000)
+    block_offsets = np.array([time.localtime(int(b)*900).tm_gmtoff for b in blocks], dtype='int64') * 1000
+    return(block_offsets[codes])
+
+def json_data_cleanup(df, save_as_csv=False, dirname=None, verbose=False, file_format='csv'):
     '''
     ppg will be stored in a separate df
     hr current, hr, st, and spo2 need to be unlisted to numerical values
@@ -72,120 +194,230 @@ def json_data_cleanup(df, save_as_csv=False, dirname=None, verbose=False):
     multi measure needs to by separated to mm_hr, mm_spo2, mm_bp_sys, mm_bp_dia, and mm_st
     activity needs to be separated to step, Calories, sleep_light, sleep_deep, and awake
     all sub-functions contains a len(df1)>0 statement, so that empty df are skipped instead of causing errors
+    save_as_csv saves the three tables in file_format (csv, parquet, or feather)
     '''
-    ppg=df[df['kind']=='ppg']
-    ppg=ppg.reset_index(drop=True)
-    acx=df[df['kind']=='acx']
-    acy=df[df['kind']=='acy']
-    acz=df[df['kind']=='acz']
-    ac=pd.concat([acx,acy,acz],ignore_index=True)
-    ac.sort_values(by='date_time')
-    a=unlist_values(df)
-    b=unlist_bp(df)
-    c=unlist_activity(df)
-    d=unlist_multi_measure(df)
-    new_df=pd.concat([a,b,c,d], ignore_index=True)
-    new_df.sort_values(by=['kind','date_time'])
+    new_df,ppg,ac=split_tables(df)
    
     if save_as_csv==True:
-        base_name=Path(dirname).parts[-1]
-        # adding '0_' to the file names so that they can be sorted on top
-        filename1=dirname + '/0_' + base_name + '_measurements.csv'
-        filename2=dirname + '/0_' + base_name + '_ppg.csv'
-        filename3=dirname + '/0_' + base_name + '_ac.csv'
         if verbose == True:
-            print('Saving to csv files..')
-            print(f'    - Saving {filename1}')
-            print(f'    - Saving {filename2}')
-            print(f'    - Saving {filename3}')
-        new_df.to_csv(filename1,index=False)
-        ppg.to_csv(filename2,index=False)
-        ac.to_csv(filename3,index=False)    
+            print(f'Saving to {file_format} files..')
+        for table,filename in zip([new_df,ppg,ac],output_names(dirname)):
+            filename=write_table(table,filename,file_format=file_format)
+            if verbose == True:
+                print(f'    - Saved {filename}')
     return
 
-def unlist_values(df):
-    df1=df[df['kind'].isin(['hr current', 'hr', 'st', 'spo2'])].copy()
-    if len(df1) > 0:
-        df1['data']=df1['data'].apply(lambda x: x[0] if isinstance(x,list) else x)
+# split the data sorted by load_json into the measurements, ppg, and ac tables
+def split_tables(df):
+    kinds=split_by_kind(df)
+    empty=df.iloc[0:0]
+    ppg=kinds.get('ppg',empty).reset_index(drop=True)
+    ac=pd.concat([kinds.get(k,empty) for k in ['acx','acy','acz']],ignore_index=True)
+    a=unlist_values([kinds[k] for k in kinds if k in ['hr current', 'hr', 'st', 'spo2']] or [empty])
+    b=unlist_bp(kinds.get('bp',empty))
+    c=unlist_activity(kinds.get('activity',empty))
+    d=unlist_multi_measure(kinds.get('multi measure',empty))
+    new_df=pd.concat([a,b,c,d], ignore_index=True)
+    return(new_df,ppg,ac)
+
+# output file names (without extension) for the measurements, ppg, and ac tables
+def output_names(dirname):
+    base_name=Path(dirname).parts[-1]
+    # adding '0_' to the file names so that they can be sorted on top
+    return([dirname + '/0_' + base_name + '_' + table for table in ['measurements','ppg','ac']])
+
+# kinds of each table in the order split_tables saves them
+STREAM_ORDER = {'measurements':['hr','hr current','spo2','st','bp_sys','bp_dia','step','Calories','sleep_light','sleep_deep','awake',
+                                'mm_hr','mm_spo2','mm_bp_sys','mm_bp_dia','mm_st'],
+                'ppg':['ppg'],
+                'ac':['acx','acy','acz']}
+
+# streaming mode: load the .json files files_per_chunk at a time and save the three tables without holding the whole day in memory
+# Each chunk is split into the three tables, and the rows of each kind are saved to temporary part files in the directory.
+# At the end the parts are joined kind by kind into the output files, which are the same as the ones json_data_cleanup saves.
+# Records are held back until the next chunk is loaded, and only the ones before the first record of the next chunk are saved.
+# If a later chunk still has earlier records (files not in time order), the kind is sorted again when its parts are joined.
+# With ref_time (and no timestamp_diff), the files are parsed once more at the start to find the first json timestamp.
+def stream_json(dirname, files_per_chunk, timestamp_diff=None, ref_time=None, file_ref_pattern=r'\d\d\d\d-\d\d-\d\d\s\d\d-\d\d-\d\d', verbose=False, recursive=False, fast_json=True, workers=1, tz=None, file_format=DEFAULT_FORMAT):
+    if dirname==None:
+        print('Error: Missing directory name.')
+        sys.exit(2)
+    file_list = search_json(dirname,recursive=recursive)
+    groups = [file_list[i:i+files_per_chunk] for i in range(0, len(file_list), files_per_chunk)]
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    part_dir = tempfile.mkdtemp(prefix='.stream_', dir=dirname)
+    parts = {table:{} for table in STREAM_ORDER}
+    templates, last_time, resort = {}, {}, set()
+    
+    def save_parts(jdata):
+        for table, df in zip(STREAM_ORDER, split_tables(jdata)):
+            templates.setdefault(table, df.iloc[0:0])
+            for kind, part in df.groupby('kind', sort=False):
+                filename = os.path.join(part_dir, f'{table}_{len(os.listdir(part_dir))}.pkl')
+                part.to_pickle(filename)
+                parts[table].setdefault(kind, []).append(filename)
+                if (table, kind) in last_time and part['date_time'].min() < last_time[(table, kind)] and (table, kind) not in resort:
+                    print(f'Warning: {kind} records are not in file order, all {kind} records will be sorted again before saving.')
+                    resort.add((table, kind))
+                last_time[(table, kind)] = max(last_time.get((table, kind), part['date_time'].max()), part['date_time'].max())
+    
+    def load_parts(table):
+        yield templates[table]
+        for kind in STREAM_ORDER[table]:
+            if kind not in parts[table]:
+                continue
+            if (table, kind) in resort:
+                yield pd.concat([pd.read_pickle(f) for f in parts[table][kind]]).sort_values(by='date_time', kind='stable')
+            else:
+                for f in parts[table][kind]:
+                    yield pd.read_pickle(f)
+    
+    try:
+        d_time = timestamp_diff
+        if d_time!=None:
+            print('Using d_time.')
+        elif ref_time!=None:
+            json_time = min(columns['time'].min() for group in groups 
+                            for columns, n, elapsed in parse_json_files(group, fast_json=fast_json, pool=pool, workers=workers) if n > 0)
+            d_time = excel_time_diff(ref_time, json_time)
+        
+        pending, json_time = None, None
+        for i, group in enumerate(groups):
+            jdata=load_json_files(group, file_ref_pattern, verbose=verbose, fast_json=fast_json, pool=pool, workers=workers)
+            if len(jdata) == 0:
+                continue
+            json_time = int(jdata['time'].min()) if json_time is None else min(json_time, int(jdata['time'].min()))
+            jdata=shift_time(jdata, d_time)
+            jdata=convert_date_time(jdata, tz=tz)
+            if pending is not None:
+                # records from earlier files come first, so records with the same kind and date_time stay in file order
+                done = pending['date_time'] < jdata['date_time'].min()
+                save_parts(pending[done])
+                jdata = pd.concat([pending[~done], jdata])
+            jdata.sort_values(by=['kind', 'date_time'], inplace=True)
+            pending = jdata
+            if verbose == True:
+                print(f'Chunk {i+1}/{len(groups)} done, {len(pending)} records held')
+        if pending is None:
+            print('Error: No records found in .json files.')
+            sys.exit(2)
+        save_parts(pending)
+        del pending, jdata
+        
+        if verbose == True:
+            print(f'Saving to {file_format} files..')
+        for table, filename in zip(STREAM_ORDER, output_names(dirname)):
+            filename=write_table_parts(partial(load_parts, table), filename, file_format=file_format)
+            if verbose == True:
+                print(f'    - Saved {filename}')
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        shutil.rmtree(part_dir, ignore_errors=True)
+    return(json_time, None if d_time==None else int(d_time))
+
+# incremental mode: parse only the new .json files of a directory and merge their records into the saved tables
+# Within each kind, the saved rows and the new rows are both sorted by date_time, so they are merged (merge_sorted) instead of
+# sorted again. Records with the same kind and date_time keep the saved ones first, like a full run when the new files come after
+# the old ones in file name order. d_time is the timestamp difference of the saved tables.
+# Returns the first json time of the new files, or None without changing the tables if a new record is earlier than json_time
+# with excel=True (the timestamp difference was found from the first json record and could change, so the directory has to be
+# processed in full).
+def append_json(dirname, file_list, d_time, json_time=None, excel=False, file_ref_pattern=r'\d\d\d\d-\d\d-\d\d\s\d\d-\d\d-\d\d', verbose=False, fast_json=True, workers=1, tz=None, file_format=DEFAULT_FORMAT):
+    if workers > 1 and len(file_list) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            jdata=load_json_files(file_list, file_ref_pattern, verbose=verbose, fast_json=fast_json, pool=pool, workers=workers)
     else:
-        pass
+        jdata=load_json_files(file_list, file_ref_pattern, verbose=verbose, fast_json=fast_json)
+    if len(jdata) == 0:
+        return(json_time)
+    new_time = int(jdata['time'].min())
+    if excel and (json_time is None or new_time < json_time):
+        print('New records are earlier than the saved ones, the timestamp difference has to be found again.')
+        return(None)
+    jdata=shift_time(jdata, d_time)
+    jdata=convert_date_time(jdata, tz=tz)
+    jdata.sort_values(by=['kind', 'date_time'], inplace=True)
+    for table, new, filename in zip(STREAM_ORDER, split_tables(jdata), output_names(dirname)):
+        saved = read_table(filename + FORMATS[file_format])
+        merged = merge_kinds(saved, new, STREAM_ORDER[table])
+        filename=write_table(merged, filename, file_format=file_format)
+        if verbose == True:
+            print(f'    - Added {len(new)} records to {filename}')
+    return(new_time if json_time is None else min(json_time, new_time))
+
+# merge the rows of two tables kind by kind, in the order of kinds; the rows of each kind are sorted by date_time in both tables
+def merge_kinds(saved, new, kinds):
+    saved_kinds, new_kinds = split_by_kind(saved), split_by_kind(new[saved.columns])
+    parts = []
+    for kind in kinds:
+        if kind in saved_kinds and kind in new_kinds:
+            parts.append(merge_sorted(saved_kinds[kind], new_kinds[kind]))
+        elif kind in saved_kinds or kind in new_kinds:
+            parts.append(saved_kinds.get(kind, new_kinds.get(kind)))
+    if len(parts) == 0:
+        return(saved)
+    return(pd.concat(parts, ignore_index=True))
+
+# merge two tables sorted by date_time in one pass: each new row goes after the saved rows with the same or an earlier date_time
+def merge_sorted(saved, new):
+    new_pos = np.searchsorted(saved['date_time'].to_numpy(), new['date_time'].to_numpy(), side='right') + np.arange(len(new))
+    is_new = np.zeros(len(saved) + len(new), dtype=bool)
+    is_new[new_pos] = True
+    rows = np.empty(len(is_new), dtype=np.int64)
+    rows[~is_new] = np.arange(len(saved))
+    rows[is_new] = len(saved) + np.arange(len(new))
+    return(pd.concat([saved, new], ignore_index=True).iloc[rows])
+
+# split the dataframe into one slice per kind, without copying
+# each kind is a contiguous block of rows (load_json sorts the data by kind, and the saved tables are in STREAM_ORDER),
+# otherwise the rows are sorted by kind first
+def split_by_kind(df):
+    kind=df['kind'].to_numpy()
+    if len(kind)==0:
+        return({})
+    bounds=np.flatnonzero(kind[1:]!=kind[:-1])+1
+    starts=np.concatenate(([0],bounds))
+    ends=np.concatenate((bounds,[len(kind)]))
+    if len(set(kind[starts])) < len(starts):
+        return(split_by_kind(df.sort_values(by='kind',kind='stable')))
+    return({kind[s]:df.iloc[s:e] for s,e in zip(starts,ends)})
+
+# the unlist functions take the rows of their own kind(s) and return new dataframes, the input slices are not modified
+def unlist_values(slices):
+    df1=pd.concat(slices)
+    df1['data']=df1['data'].apply(lambda x: x[0] if isinstance(x,list) else x)
     return(df1)
 
-def unlist_bp(df):
-    df1=df[df['kind']=='bp'].copy()
+def unlist_bp(df1):
     if len(df1) > 0:
-        df1[['bp_sys','bp_dia']]=pd.DataFrame(df1.data.tolist(), index= df1.index)
-        df1.drop(['data','kind'],axis = 1,inplace=True)
-        df1=pd.melt(df1, id_vars=['jname','date_time','date','time'],value_vars=['bp_sys','bp_dia'],
-                value_name='data',var_name='kind')
-    else:
-        pass
+        values=pd.DataFrame(df1.data.tolist(), index= df1.index, columns=['bp_sys','bp_dia'])
+        df1=pd.melt(pd.concat([df1[['jname','date_time','date','time']],values],axis=1),
+                    id_vars=['jname','date_time','date','time'],value_vars=['bp_sys','bp_dia'],
+                    value_name='data',var_name='kind')
     return(df1)
 
-def unlist_activity(df):
-    df1=df[df['kind']=='activity'].copy()
+def unlist_activity(df1):
     if len(df1) > 0:
-        df1[['step','Calories','sleep_light','sleep_deep','awake']]=pd.DataFrame(df1.data.tolist(), index= df1.index)
-        df1.drop(['data','kind'],axis = 1,inplace=True)
-        df1=pd.melt(df1, id_vars=['jname','date_time','date','time'],
+        values=pd.DataFrame(df1.data.tolist(), index= df1.index, columns=['step','Calories','sleep_light','sleep_deep','awake'])
+        df1=pd.melt(pd.concat([df1[['jname','date_time','date','time']],values],axis=1),
+                    id_vars=['jname','date_time','date','time'],
                     value_vars=['step','Calories','sleep_light','sleep_deep','awake'],
                     value_name='data',var_name='kind')
-    else:
-        pass
     return(df1)
 
-def unlist_multi_measure(df):
-    df1=df[df['kind']=='multi measure'].copy()
+def unlist_multi_measure(df1):
     if len(df1) > 0:
-        df1[['mm_hr', 'mm_spo2', 'mm_bp', 'mm_st']]=pd.DataFrame(df1.data.tolist(), index= df1.index)
-        df1[['mm_bp_sys','mm_bp_dia']]=pd.DataFrame(df1.mm_bp.tolist(), index= df1.index)
-        df1.drop(['data','kind','mm_bp'],axis = 1,inplace=True)
-        df1=pd.melt(df1, id_vars=['jname','date_time','date','time'],
+        values=pd.DataFrame(df1.data.tolist(), index= df1.index, columns=['mm_hr', 'mm_spo2', 'mm_bp', 'mm_st'])
+        bp_values=pd.DataFrame(values.mm_bp.tolist(), index= df1.index, columns=['mm_bp_sys','mm_bp_dia'])
+        df1=pd.melt(pd.concat([df1[['jname','date_time','date','time']],values.drop('mm_bp',axis=1),bp_values],axis=1),
+                    id_vars=['jname','date_time','date','time'],
                     value_vars=['mm_hr', 'mm_spo2', 'mm_bp_sys','mm_bp_dia', 'mm_st'],
                     value_name='data',var_name='kind')
-    else:
-        pass
     return(df1)
 
-# data loading functions
-def load_excel(file_name):
-    out_df = pd.DataFrame(columns=['Time','kind','data'])
-    feature_rename={ 'Heart rate (bpm)':'hr',
-                    'Diastolic (mmHg)':'bp_dia',
-                    'Systolic (mmHg)':'bp_sys',
-                    'SaO2 (%)':'spo2',
-                    'Body temperature (C)':'st', 
-                    'Pedometer':'step',
-                    'Total sleep':'sleep_total',
-                    'Deep sleep':'sleep_deep',
-                    'Light sleep':'sleep_light',
-                    'Event Markers':'Event_markers'}
-    wb = load_workbook(file_name)
-    for sheet in wb.worksheets:
-        data = sheet.values
-        header = next(data)
-        header = [feature_rename[x] if x in feature_rename else x for x in header]
-        data = list(data)
-        df = pd.DataFrame(data,columns=header)
-        if 'sleep_total' in header:
-            df['sleep_total'] = df['sleep_total'].apply(lambda x: to_minutes(x) if len(x) > 0 else x)
-            df['sleep_deep'] = df['sleep_deep'].apply(lambda x: to_minutes(x) if len(x) > 0 else x)
-            df['sleep_light'] = df['sleep_light'].apply(lambda x: to_minutes(x) if len(x) > 0 else x)
-        df = pd.melt(df, id_vars=['Time'], value_vars=header[1:], var_name='kind', value_name='data')
-        df = df[df['kind'] != 'Body temperature (F)']
-        df = df[df['data'] != '']
-        out_df = pd.concat([out_df,df],ignore_index=True)
-    out_df.reset_index(inplace = True, drop = True)
-    out_df.rename(columns={'Time':'date_time'},inplace=True)
-    out_df['date_time'] = pd.to_datetime(out_df['date_time'])
-    return(out_df)
-
-def to_minutes(t):
-    hs=t.strip('m').split('h')
-    return int(hs[0])*60+int(hs[1])
-
 # Help message:
-help_msg ='''This script processes all .json files and convert them into .csv files for faster access in later steps.
+help_msg ='''This script processes all .json files and convert them into .parquet (or .csv) files for faster access in later steps.
 Accelerations, ppg, and all other measurements will be split into 3 sepearate files. 
     
 Usage: python raw_data_reformat.py -d <dirname> [options]
@@ -197,17 +429,32 @@ Options:
     -h or --help: print help document
     -e: Provide matching computed data for timestamp matching
     -t: Provide existing timestamp difference file.
+    --tdiff-out: file to save the timestamp difference in (default: timestamp_diff.txt two folders above the -d directory)
     -r: Recursive search mode
+    -j: number of worker processes for parsing .json files (default 1)
+    --append: only read the .json files added since the last run, and merge their records into the saved files.
+              The directory is processed in full if other files or options changed since then.
+    --stream: streaming mode, load this number of .json files at a time instead of the whole day at once.
+              Uses less memory on long recordings but takes longer; the output files are the same.
+    --tz: time zone of the recording, e.g. America/Los_Angeles (default: time zone of this computer)
+    --format: output file format, parquet (default if pyarrow is installed), feather, or csv
+    --xlsx-cache: save a parsed copy of the -e file next to it (in .xlsx_cache), used again while the file is unchanged
     -v: Verbose mode
 '''
 
 def main():
     arg_list = sys.argv[1:]
-    short_opts = 'e:t:d:hv'
-    long_opts = ['help']
+    short_opts = 'e:t:d:j:rhv'
+    long_opts = ['help','format=','tz=','stream=','xlsx-cache','append','tdiff-out=']
     global verbose
     verbose = False
     recur = False
+    workers = 1
+    tz = None
+    file_format = DEFAULT_FORMAT
+    files_per_chunk = 0
+    xlsx_cache = False
+    append = False
     
     try:
         opt_list = getopt.getopt(arg_list, short_opts, long_opts)[0]
@@ -223,7 +470,7 @@ def main():
         verbose = True
     
     # Initialize variables
-    dir_name,xlsx_file,tdiff_file = '','',''    
+    dir_name,xlsx_file,tdiff_file,tdiff_out = '','','',None
     # Parse options
     for current_opt,current_val in opt_list:
         if current_opt == '-d':
@@ -235,9 +482,41 @@ def main():
         elif current_opt == '-t':
             msg(f'Timestamp difference file: "{current_val}"')
             tdiff_file = current_val
+        elif current_opt == '--tdiff-out':
+            tdiff_out = current_val
         elif current_opt == '-r':
             msg('Recursive search on.')
             recur = True
+        elif current_opt == '-j':
+            try:
+                workers = int(current_val)
+            except ValueError:
+                print(f'Invalid number of workers: {current_val}')
+                sys.exit(2)
+            msg(f'Using {workers} worker processes.')
+        elif current_opt == '--tz':
+            tz = current_val
+            msg(f'Time zone: {tz}')
+        elif current_opt == '--format':
+            file_format = current_val
+            format_err = check_format(file_format)
+            if format_err != '':
+                print(format_err)
+                sys.exit(2)
+            msg(f'Output file format: {file_format}')
+        elif current_opt == '--xlsx-cache':
+            xlsx_cache = True
+        elif current_opt == '--append':
+            append = True
+        elif current_opt == '--stream':
+            try:
+                files_per_chunk = int(current_val)
+            except ValueError:
+                files_per_chunk = 0
+            if files_per_chunk < 1:
+                print(f'Invalid number of files for --stream: {current_val}')
+                sys.exit(2)
+            msg(f'Streaming mode, {files_per_chunk} files at a time.')
     
     if dir_name == '':
         print('Directory containing all .json files is not defined. Exiting.')
@@ -245,23 +524,41 @@ def main():
     
     if len(os.listdir(dir_name)) == 0:
         print("Empty directory, skipping.")
-    elif (len(glob.glob(dir_name + '/0_*_measurements.csv'))==0) or (len(glob.glob(dir_name + '/0_*_ppg.csv'))==0) or (len(glob.glob(dir_name + '/0_*_ac.csv'))==0):
-        if xlsx_file != '':
-            e_df = load_excel(xlsx_file)
-            min_time = datetime.timestamp(min(e_df['date_time']))
-            j_df_all=load_json(dir_name, timestamp_diff=None, ref_time=min_time,verbose=verbose, recursive=recur)
-            json_data_cleanup(j_df_all,save_as_csv=True,dirname=dir_name,verbose=verbose)
-        elif tdiff_file != '':
-            with open(tdiff_file) as f:
-                dt=f.readlines()
-                dt=int(dt[0])
-            j_df_all=load_json(dir_name, timestamp_diff=dt, ref_time=None,verbose=verbose, recursive=recur)
-            json_data_cleanup(j_df_all,save_as_csv=True,dirname=dir_name,verbose=verbose)
-        else:
-            j_df_all=load_json(dir_name, timestamp_diff=None, ref_time=None,verbose=verbose, recursive=recur)
-            json_data_cleanup(j_df_all,save_as_csv=True,dirname=dir_name,verbose=verbose)
+        return
+    # skip the directory if the outputs were made from the same files with the same options (see data_io.stage_up_to_date)
+    inputs = search_json(dir_name,recursive=recur) + [f for f in (xlsx_file,tdiff_file) if f != '']
+    params = {'excel':xlsx_file != '','timestamp_diff':tdiff_file != '','tz':tz,'format':file_format}
+    outputs = [name + FORMATS[file_format] for name in output_names(dir_name)]
+    if stage_up_to_date(dir_name,'raw_data_reformat',inputs,params,outputs):
+        print("Files are up to date, skipping.")
+        return
+    new_files = stage_new_inputs(dir_name,'raw_data_reformat',inputs,params,outputs) if append else None
+    if new_files is not None:
+        extra = stage_extra(dir_name,'raw_data_reformat')
+        print(f'Adding {len(new_files)} new .json files.')
+        json_time = append_json(dir_name, new_files, extra.get('d_time'), json_time=extra.get('json_time'), excel=xlsx_file != '', 
+                                verbose=verbose, workers=workers, tz=tz, file_format=file_format)
+        if json_time is not None:
+            save_stage(dir_name,'raw_data_reformat',inputs,params,outputs,extra={'d_time':extra.get('d_time'),'json_time':json_time})
+            return
+    elif append:
+        print('No saved files to add to, processing all files.')
+    dt,min_time = None,None
+    if xlsx_file != '':
+        e_df = load_excel(xlsx_file, cache=xlsx_cache)
+        min_time = datetime.timestamp(min(e_df['date_time']))
+    elif tdiff_file != '':
+        with open(tdiff_file) as f:
+            dt=f.readlines()
+            dt=int(dt[0])
+    if files_per_chunk > 0:
+        json_time, d_time = stream_json(dir_name, files_per_chunk, timestamp_diff=dt, ref_time=min_time, verbose=verbose, recursive=recur, workers=workers, tz=tz, file_format=file_format)
     else:
-        print("Files exist, skipping.")
+        j_df_all=load_json(dir_name, timestamp_diff=dt, ref_time=min_time,verbose=verbose, recursive=recur, workers=workers, tz=tz)
+        json_time, d_time = j_df_all.attrs['json_time'], j_df_all.attrs['d_time']
+        json_data_cleanup(j_df_all,save_as_csv=True,dirname=dir_name,verbose=verbose,file_format=file_format)
+    save_time_diff(d_time, tdiff_out if tdiff_out is not None else time_diff_file(dir_name))
+    save_stage(dir_name,'raw_data_reformat',inputs,params,outputs,extra={'d_time':d_time,'json_time':json_time})
 
 # verbose function for printing messages
 def msg(text):
@@ -284,8 +581,4 @@ def validate_file(file_path,accepted_formats=''):
         sys.exit(2)
     
 if __name__ == '__main__':
-    import sys, os, getopt, glob,re
-    from pathlib import Path
-    from datetime import datetime
-    import pandas as pd
     main()
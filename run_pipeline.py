@@ -0,0 +1,306 @@
+import sys, os, io, re, glob, getopt, time, runpy, traceback, contextlib
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+# Run the whole pipeline on a cohort: every subject folder and every day folder in it, several at a time.
+# The stage scripts are run inside the worker processes (runpy), so pandas and the other modules are imported once per worker
+# instead of once per script call. Stages that are up to date skip their work (see data_io.stage_up_to_date), so running
+# the pipeline again after a failure or after new files arrived only does the remaining work.
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+STAGES = ['organize_raw_files','raw_data_reformat','acc_reformat','filtering_data','activity_categorize']
+DAY_PATTERN = re.compile(r'(.+)_(\d{4}-\d{2}-\d{2})')
+TASK_STAGE = {'organize':'organize_raw_files','day':'raw_data_reformat','filtering':'filtering_data','activity':'activity_categorize'}
+
+help_msg ='''This script runs all steps of the pipeline on a cohort, several subject-days at a time.
+
+Usage: python run_pipeline.py -d <cohort_dir> [options]
+
+Arguments:
+    -d: cohort directory with one folder per subject. In each subject folder:
+        - raw .zip or .json files are organized into day folders first (organize_raw_files.py -z, or -j for .json files)
+        - day folders <stem>_YYYY-MM-DD are processed by raw_data_reformat.py (--append) and acc_reformat.py
+        - computed files <stem>_YYYY-MM-DD.xlsx are used for timestamp matching of the day with the same name,
+          then filtered together (filtering_data.py) and used with all days to categorize the activity (activity_categorize.py)
+        The subject results are saved in the subject folder, named after the folder (e.g. subject_filtered.parquet),
+        with the timestamp difference found for its last processed day (timestamp_diff.txt).
+
+Options:
+    -h or --help: print help document
+    -c: directory with the computed .xlsx files, if they are not in the subject folders
+    -w: number of worker processes (default 1)
+    --format: output file format, parquet (default if pyarrow is installed), feather, or csv
+    --tz: time zone of the recordings, e.g. America/Los_Angeles (default: time zone of this computer)
+    -v: Verbose mode, print the output of every stage
+
+A failed stage is reported at the end, and the stages that depend on it are not run (the activity of a subject needs all its days).
+Run the same command again to resume: finished stages are skipped.
+'''
+
+def main():
+    arg_list = sys.argv[1:]
+    short_opts = 'd:c:w:hv'
+    long_opts = ['help','format=','tz=']
+    global verbose
+    verbose = False
+
+    try:
+        opt_list = getopt.getopt(arg_list, short_opts, long_opts)[0]
+    except getopt.error as err:
+        print(str(err))
+        sys.exit(2)
+
+    if (('--help','') in opt_list) or (('-h','') in opt_list) or len(opt_list)==0:
+        print(help_msg)
+        sys.exit(0)
+
+    if ('-v','') in opt_list:
+        verbose = True
+
+    # Initialize variables
+    cohort_dir, computed_dir = '', None
+    workers = 1
+    file_format, tz = None, None
+    for current_opt,current_val in opt_list:
+        if current_opt == '-d':
+            cohort_dir = current_val
+        elif current_opt == '-c':
+            computed_dir = current_val
+            if not Path(computed_dir).is_dir():
+                print(f'Error: "{computed_dir}" is not a directory.')
+                sys.exit(2)
+        elif current_opt == '-w':
+            try:
+                workers = int(current_val)
+            except ValueError:
+                workers = 0
+            if workers < 1:
+                print(f'Invalid number of workers: {current_val}')
+                sys.exit(2)
+        elif current_opt == '--format':
+            file_format = current_val
+        elif current_opt == '--tz':
+            tz = current_val
+
+    if cohort_dir == '' or not Path(cohort_dir).is_dir():
+        print('Cohort directory (-d) is not defined or does not exist. Exiting.')
+        sys.exit(2)
+    from data_io import check_format, FORMATS, DEFAULT_FORMAT # data_io loads pandas, only imported once the other options are checked
+    if file_format is None:
+        file_format = DEFAULT_FORMAT
+    format_err = check_format(file_format)
+    if format_err != '':
+        print(format_err)
+        sys.exit(2)
+
+    subjects = sorted(str(p) for p in Path(cohort_dir).absolute().iterdir() if p.is_dir() and not p.name.startswith('.'))
+    if len(subjects) == 0:
+        print(f'No subject folders found in {cohort_dir}.')
+        sys.exit(2)
+    options = {'computed_dir':None if computed_dir is None else os.path.abspath(computed_dir),'format':file_format,'ext':FORMATS[file_format],'tz':tz}
+    print(f'{len(subjects)} subjects, {workers} workers.')
+    t_start = time.perf_counter()
+    timings, skipped, failures = run_cohort(subjects, options, workers)
+    print_summary(timings, skipped, failures, time.perf_counter() - t_start)
+    if len(failures) > 0:
+        sys.exit(1)
+
+# verbose function for printing messages
+def msg(text):
+    global verbose
+    if verbose == True:
+        print(text)
+
+# Scheduler: the stages of all subjects are run in a process pool as soon as the stages they depend on are done.
+# organize (subject) -> raw_data_reformat and acc_reformat (each day, one task) -> activity_categorize (subject, after all its
+# days and filtering_data). filtering_data only needs the computed files and runs at the same time as the days.
+# Returns the run time of every stage that was run, the number of runs that were skipped (up to date),
+# and the failed stages with their output.
+def run_cohort(subjects, options, workers=1):
+    timings = {stage:[] for stage in STAGES}
+    skipped = {stage:0 for stage in STAGES}
+    failures = []
+    pending = {} # running tasks: future -> (task, subject, day)
+    waiting = {} # subjects waiting for their days and filtering: subject -> [unfinished tasks, failed]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        def submit(task, subject, day=None, computed=None):
+            if task == 'organize':
+                future = pool.submit(run_organize, subject, options)
+            elif task == 'day':
+                future = pool.submit(run_day, subject, day, computed.get(Path(day).name), options)
+            elif task == 'filtering':
+                future = pool.submit(run_filtering, subject, computed, options)
+            else:
+                future = pool.submit(run_activity, subject, options)
+            pending[future] = (task, subject, day)
+
+        # the day folders of a subject are found after organizing, then its days and filtering are started
+        def start_subject(subject):
+            days = find_days(subject)
+            if len(days) == 0:
+                print(f'No day folders in {subject}, skipping.')
+                return
+            computed = computed_files(subject, days, options)
+            waiting[subject] = [len(days) + 1, False]
+            for day in days:
+                submit('day', subject, day, computed)
+            submit('filtering', subject, computed=computed)
+
+        for subject in subjects:
+            if has_raw_files(subject):
+                submit('organize', subject)
+            else:
+                start_subject(subject)
+
+        while len(pending) > 0:
+            done = wait(pending, return_when=FIRST_COMPLETED)[0]
+            for future in done:
+                task, subject, day = pending.pop(future)
+                try:
+                    results = future.result()
+                except Exception: # the worker process itself failed (e.g. out of memory)
+                    results = [(TASK_STAGE[task], False, 0, traceback.format_exc())]
+                failed = False
+                for stage, ok, seconds, output in results:
+                    timings[stage].append(seconds)
+                    skipped[stage] += 'up to date, skipping' in output
+                    name = day if day is not None else subject
+                    if ok:
+                        msg(f'{stage} finished for {name} ({seconds:.1f} s)\n{output}')
+                    else:
+                        failed = True
+                        failures.append((stage, name, output))
+                        print(f'{stage} failed for {name}.')
+                if task == 'organize':
+                    if not failed:
+                        start_subject(subject)
+                elif task in ['day','filtering']:
+                    waiting[subject][0] -= 1
+                    waiting[subject][1] = waiting[subject][1] or failed
+                    if waiting[subject][0] == 0:
+                        if waiting[subject][1]:
+                            print(f'Skipping activity_categorize for {subject}, some of its stages failed.')
+                        else:
+                            submit('activity', subject)
+    return(timings, skipped, failures)
+
+# print the number of runs and the time of each stage (the time of a stage summed over all subjects or days)
+def print_summary(timings, skipped, failures, wall_time):
+    print(f'\n{"Stage":<22}{"Runs":>6}{"Up to date":>12}{"Failed":>8}{"Total (s)":>12}{"Longest (s)":>13}')
+    for stage in STAGES:
+        n_failed = len([f for f in failures if f[0] == stage])
+        longest = max(timings[stage]) if len(timings[stage]) > 0 else 0
+        print(f'{stage:<22}{len(timings[stage]):>6}{skipped[stage]:>12}{n_failed:>8}{sum(timings[stage]):>12.1f}{longest:>13.1f}')
+    print(f'Wall time: {wall_time:.1f} s')
+    for stage, name, output in failures:
+        print(f'\n{stage} failed for {name}:\n{output.rstrip()}')
+    if len(failures) > 0:
+        print(f'\n{len(failures)} stages failed. Run the same command again to resume after fixing them.')
+
+# run a stage script in this process as if it was called from the command line, with its printed output captured
+# Returns (stage, ok, seconds, output). The script fails if it exits with an error or raises an exception.
+def run_stage(stage, args):
+    argv = sys.argv
+    sys.argv = [stage + '.py'] + [str(a) for a in args]
+    output = io.StringIO()
+    t_start = time.perf_counter()
+    ok = True
+    try:
+        with contextlib.redirect_stdout(output):
+            runpy.run_path(os.path.join(SCRIPT_DIR, stage + '.py'), run_name='__main__')
+    except SystemExit as err:
+        if err.code not in [None, 0]:
+            ok = False
+            if not isinstance(err.code, int):
+                output.write(str(err.code) + '\n')
+    except Exception:
+        ok = False
+        output.write(traceback.format_exc())
+    finally:
+        sys.argv = argv
+        if 'data_io' in sys.modules: # the worker goes on to other subjects, their archives are opened again when needed
+            sys.modules['data_io'].close_zip_archives()
+    return(stage, ok, time.perf_counter() - t_start, output.getvalue())
+
+# organize the raw .zip and .json files of a subject into day folders named after the computed files
+def run_organize(subject, options):
+    stem = subject_stem(subject, options)
+    results = []
+    if len(glob.glob(os.path.join(subject, '*.zip'))) > 0:
+        results.append(run_stage('organize_raw_files', ['-d', subject, '-o', os.path.join(subject, stem), '-z']))
+    if len(glob.glob(os.path.join(subject, '*.json'))) > 0 and all(ok for stage, ok, seconds, output in results):
+        results.append(run_stage('organize_raw_files', ['-d', subject, '-o', os.path.join(subject, stem), '-j']))
+    return(results)
+
+# reformat the raw data of one day (matched with its computed file if there is one), then its acceleration
+# the second step reads the output of the first. The timestamp difference is saved in the subject folder (the last day wins).
+def run_day(subject, day, computed_file, options):
+    args = ['-d', day, '--append', '--format', options['format'], '--tdiff-out', os.path.join(subject, 'timestamp_diff.txt')]
+    if computed_file is not None:
+        args += ['-e', computed_file]
+    if options['tz'] is not None:
+        args += ['--tz', options['tz']]
+    results = [run_stage('raw_data_reformat', args)]
+    if results[0][1]:
+        ac_file = os.path.join(day, '0_' + Path(day).name + '_ac' + options['ext'])
+        results.append(run_stage('acc_reformat', ['-f', ac_file, '--format', options['format']]))
+    return(results)
+
+# filter the computed files of a subject (all days together)
+def run_filtering(subject, computed, options):
+    stems = set(DAY_PATTERN.fullmatch(name).group(1) for name in computed)
+    dirs = set(os.path.dirname(f) for f in computed.values())
+    if len(computed) == 0:
+        return([('filtering_data', False, 0, f'No computed .xlsx files found for {subject}.\n')])
+    if len(stems) > 1 or len(dirs) > 1:
+        return([('filtering_data', False, 0, f'The computed files of {subject} have more than one name stem or folder: {", ".join(sorted(stems | dirs))}\n')])
+    save_file = os.path.join(subject, Path(subject).name + '_filtered' + options['ext'])
+    return([run_stage('filtering_data', ['-d', dirs.pop(), '-p', stems.pop() + '_*.xlsx', '-s', save_file, '--format', options['format']])])
+
+# categorize the activity of a subject from its filtered data and the acceleration of all its days
+def run_activity(subject, options):
+    filtered = os.path.join(subject, Path(subject).name + '_filtered' + options['ext'])
+    return([run_stage('activity_categorize', ['-f', filtered, '-a', subject, '-s', os.path.join(subject, Path(subject).name), '--format', options['format']])])
+
+# check for raw files to organize (.zip or .json files directly in the subject folder)
+def has_raw_files(subject):
+    return(len(glob.glob(os.path.join(subject, '*.zip'))) + len(glob.glob(os.path.join(subject, '*.json'))) > 0)
+
+# folders and files in dirname and its subfolders, without looking into hidden folders and day folders (which hold the raw files)
+# returns the day folders (<stem>_YYYY-MM-DD) and the other files
+def walk_subject(dirname):
+    days, files = [], []
+    for parent, subdirs, names in os.walk(dirname):
+        days += [os.path.join(parent, d) for d in subdirs if DAY_PATTERN.fullmatch(d)]
+        files += [os.path.join(parent, f) for f in names]
+        subdirs[:] = [d for d in subdirs if not d.startswith('.') and not DAY_PATTERN.fullmatch(d)]
+    return(sorted(days), sorted(files))
+
+def find_days(subject):
+    return(walk_subject(subject)[0])
+
+# computed files <stem>_YYYY-MM-DD.xlsx of a subject, by name (without extension)
+# from the -c directory if given (only the ones named like the day folders of the subject), otherwise from the subject folder
+def computed_files(subject, days, options):
+    if options['computed_dir'] is None:
+        files, names = walk_subject(subject)[1], None
+    else:
+        files, names = walk_subject(options['computed_dir'])[1], set(Path(d).name for d in days)
+    computed = {}
+    for f in files:
+        name = Path(f).stem
+        if Path(f).suffix == '.xlsx' and DAY_PATTERN.fullmatch(name) and (names is None or name in names):
+            computed[name] = f
+    return(computed)
+
+# name stem for the day folders of a subject: the name stem of its computed files, so that each day is matched with the
+# computed file of the same date, or the stem of its existing day folders; the name of the subject folder if there is not exactly one
+def subject_stem(subject, options):
+    days = find_days(subject)
+    stems = set(DAY_PATTERN.fullmatch(name).group(1) for name in computed_files(subject, days, options))
+    if len(stems) != 1:
+        stems = set(DAY_PATTERN.fullmatch(Path(d).name).group(1) for d in days)
+    return(stems.pop() if len(stems) == 1 else Path(subject).name)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,4 @@
+import os, sys
+
+# The pipeline scripts are run from the repository folder and import each other as top-level modules
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,203 @@
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import pytest
+import acc_reformat
+acc_reformat.verbose = False # set by main() when the script is run
+
+# Checks of the searchsorted alignment in acc_reformat.match_acc against the previous list-popping implementation,
+# which is kept below (unchanged apart from the verbose messages) as the reference.
+
+def old_xyz_match(x,y,z,t=0.5):
+    a=abs((x-y).total_seconds())
+    b=abs((y-z).total_seconds())
+    c=abs((y-z).total_seconds())
+    if max(a,b,c)>t:
+        return False
+    else: 
+        return True
+
+def old_find_match(list_x,list_y,list_z,t=0.4):
+    t_comb=[]
+    i=0
+    while i < len(list_x):
+        j=0
+        while j < len(list_y):
+            k=0
+            while k < len(list_z):
+                m=old_xyz_match(list_x[i],list_y[j],list_z[k],t=t)
+                comb=(i,list_x[i],j,list_y[j],k,list_z[k],i+j+k,m)
+                t_comb.append(comb)
+                k=k+1
+            j=j+1
+        i=i+1
+    t_comb=pd.DataFrame(t_comb,columns=['index_x','time_x','index_y','time_y','index_z','time_z','total_changes','xyz_match'])
+    t_comb.sort_values(by='total_changes',inplace=True)
+    t_comb.reset_index(drop=True,inplace=True)
+    for i in range(0,len(t_comb),1):
+        if t_comb['xyz_match'][i]:
+            return [t_comb['index_x'][i],t_comb['index_y'][i],t_comb['index_z'][i]]
+    return []
+
+def old_match_acc(x,y,z,n):
+    a=0
+    t_x=x['date_time'].tolist()
+    val_x=x['data'].tolist()
+    t_y=y['date_time'].tolist()
+    val_y=y['data'].tolist()
+    t_z=z['date_time'].tolist()
+    val_z=z['data'].tolist()
+    while a<(len(t_x)-n) and a<(len(t_y)-n) and a<(len(t_z)-n):
+        if not old_xyz_match(t_x[a],t_y[a],t_z[a]):
+            lx,ly,lz=t_x[a:a+n],t_y[a:a+n],t_z[a:a+n]
+            first_match=[]
+            first_match=first_match+old_find_match(lx,ly,lz)
+            while len(first_match)==0:
+                n=n+2
+                lx,ly,lz=t_x[a:a+n],t_y[a:a+n],t_z[a:a+n]
+                first_match=[]
+                first_match=first_match+old_find_match(lx,ly,lz)
+            for i in range(0,first_match[0],1):
+                t_x.pop(a)
+                val_x.pop(a)
+            for i in range(0,first_match[1],1):
+                t_y.pop(a)
+                val_y.pop(a)
+            for i in range(0,first_match[2],1):
+                t_z.pop(a)
+                val_z.pop(a)
+        a=a+1
+    del t_x[a:len(t_x)]
+    del val_x[a:len(val_x)]
+    del t_y[a:len(t_y)]
+    del val_y[a:len(val_y)]
+    del t_z[a:len(t_z)]
+    del val_z[a:len(val_z)]
+    new_x=pd.DataFrame({'date_time':t_x,'data':val_x})
+    new_y=pd.DataFrame({'date_time':t_y,'data':val_y})
+    new_z=pd.DataFrame({'date_time':t_z,'data':val_z})
+    return new_x,new_y,new_z
+
+def old_smooth_timestamp(start_row,current_row,start_time):
+    local_format='%Y-%m-%d %H:%M:%S.%f'
+    start_time=datetime.timestamp(start_time)
+    t0=(start_time-0.4)+0.5*(current_row-start_row)
+    t1,t2,t3,t4=t0+0.1,t0+0.2,t0+0.3,t0+0.4
+    t0f=datetime.fromtimestamp(t0).strftime(local_format)
+    t1f=datetime.fromtimestamp(t1).strftime(local_format)
+    t2f=datetime.fromtimestamp(t2).strftime(local_format)
+    t3f=datetime.fromtimestamp(t3).strftime(local_format)
+    t4f=datetime.fromtimestamp(t4).strftime(local_format)
+    return [t0f,t1f,t2f,t3f,t4f]
+
+def old_acc_flatten(ac,match_range=6):
+    top_row = pd.DataFrame({'kind':'ac','date_time':datetime.fromtimestamp(1),'data':'NA'},index=[0])
+    ac_slim=ac[['kind','date_time','data']]
+    acx=pd.concat([top_row,ac_slim[ac_slim['kind']=='acx']]).reset_index(drop=True)
+    acx['date_time'] = pd.to_datetime(acx['date_time'])
+    acy=pd.concat([top_row,ac_slim[ac_slim['kind']=='acy']]).reset_index(drop=True)
+    acy['date_time'] = pd.to_datetime(acy['date_time'])
+    acz=pd.concat([top_row,ac_slim[ac_slim['kind']=='acz']]).reset_index(drop=True)
+    acz['date_time'] = pd.to_datetime(acz['date_time'])
+    acc_filt=old_match_acc(acx,acy,acz,n=match_range)
+    acx,acy,acz=acc_filt[0],acc_filt[1],acc_filt[2]
+    nrows_ac = min(len(acx),len(acy),len(acz))
+    df = pd.DataFrame(columns=['acx','acy','acz','date_time'])
+    start_row = 0
+    start_time = datetime.fromtimestamp(1)
+    for i in range(1,nrows_ac,1):
+        dt=(acx['date_time'][i]-acx['date_time'][i-1]).total_seconds()
+        if dt>1:
+            start_row = i
+            start_time = acx['date_time'][i]
+        t_smooth=old_smooth_timestamp(start_row,i,start_time)
+        df_row=pd.DataFrame({'acx':acx['data'][i],'acy':acy['data'][i],'acz':acz['data'][i],'date_time':t_smooth})
+        df=pd.concat([df,df_row])
+    df.reset_index(drop=True,inplace=True)
+    df['date_time']=pd.to_datetime(df['date_time'])
+    return df
+
+# the old acc_flatten put a dummy record in front of each component and skipped it after matching
+def reference_match(x,y,z,match_range=6):
+    top=pd.DataFrame({'date_time':[pd.Timestamp(datetime.fromtimestamp(1))],'data':['NA']})
+    matched=old_match_acc(*[pd.concat([top,df],ignore_index=True) for df in (x,y,z)],n=match_range)
+    return [df.iloc[1:].reset_index(drop=True) for df in matched]
+
+# records every 0.5 s of a 10 Hz stream (5 samples each), the three components a few ms apart
+# drop is the fraction of records missing in each component
+def make_streams(n_records,drop=0.0,seed=0):
+    rng=np.random.default_rng(seed)
+    base=pd.Timestamp('2022-01-26 08:00:00')+pd.to_timedelta(np.arange(n_records)*500+rng.integers(-40,40,n_records),unit='ms')
+    streams=[]
+    for kind in ['acx','acy','acz']:
+        keep=rng.random(n_records)>=drop
+        t=base[keep]+pd.to_timedelta(rng.integers(0,30,keep.sum()),unit='ms')
+        streams.append(pd.DataFrame({'kind':kind,'date_time':t,'data':[list(rng.random(5)) for _ in range(keep.sum())]}))
+    return streams
+
+def matched_times(dfs):
+    return [df['date_time'].to_numpy(dtype='datetime64[ns]') for df in dfs]
+
+@pytest.mark.parametrize('seed',[0,1,2])
+def test_clean_streams_match_reference(seed):
+    x,y,z=make_streams(1000,seed=seed)
+    old=reference_match(x,y,z)
+    new=acc_reformat.match_acc(x,y,z)
+    # the same records are paired; the old scan only threw away the last match_range (6) records
+    assert len(new[0])==1000
+    assert len(old[0])==1000-6
+    for old_df,new_df in zip(old,new):
+        assert (matched_times([old_df])[0]==matched_times([new_df])[0][:len(old_df)]).all()
+        assert old_df['data'].tolist()==new_df['data'].tolist()[:len(old_df)]
+
+@pytest.mark.filterwarnings('ignore::FutureWarning') # pd.concat onto the empty table in the old code
+def test_clean_streams_flatten_like_reference():
+    x,y,z=make_streams(300,seed=3)
+    # a gap of more than a second restarts the smoothed timestamps
+    x,y,z=[pd.concat([df.iloc[:150],df.iloc[150:].assign(date_time=df['date_time'].iloc[150:]+pd.Timedelta(seconds=5))]) for df in (x,y,z)]
+    ac=pd.concat([x,y,z],ignore_index=True)
+    old=old_acc_flatten(ac)
+    new=acc_reformat.acc_flatten(ac)
+    new=new.iloc[:len(old)]
+    for col in ['acx','acy','acz']:
+        assert old[col].astype(float).tolist()==new[col].tolist()
+    # the old timestamps went through float epoch seconds and were cut to whole microseconds
+    diff=np.abs(old['date_time'].to_numpy(dtype='datetime64[ns]')-new['date_time'].to_numpy(dtype='datetime64[ns]'))
+    assert (diff<=np.timedelta64(1,'us')).all()
+
+@pytest.mark.parametrize('seed',[0,1,2])
+def test_dropped_packets(seed):
+    x,y,z=make_streams(1000,drop=0.03,seed=seed)
+    old=reference_match(x,y,z)
+    new=acc_reformat.match_acc(x,y,z)
+    t_x,t_y,t_z=matched_times(new)
+    # every x and z record is within 0.5 s of the y record it is paired with
+    assert (np.abs(t_x-t_y)<=np.timedelta64(500,'ms')).all()
+    assert (np.abs(t_z-t_y)<=np.timedelta64(500,'ms')).all()
+    # no record is used twice, and the rows stay in time order
+    for t in (t_x,t_y,t_z):
+        assert len(np.unique(t))==len(t)
+        assert (np.diff(t)>np.timedelta64(0,'ns')).all()
+    # the accepted differences: where the old greedy scan paired a record with a neighbouring packet that was still within
+    # 0.5 s, the nearest one is paired now. Most triples are the same, and no fewer records are kept.
+    old_triples=set(zip(*matched_times(old)))
+    new_triples=set(zip(t_x,t_y,t_z))
+    assert len(old_triples & new_triples)>=0.9*len(old_triples)
+    assert len(new_triples)>=len(old_triples)
+
+def test_nearest_match_uses_each_record_once():
+    ref=np.array(['2022-01-26T00:00:00.000','2022-01-26T00:00:00.300','2022-01-26T00:00:02.000'],dtype='datetime64[ns]')
+    other=np.array(['2022-01-26T00:00:00.200','2022-01-26T00:00:03.000'],dtype='datetime64[ns]')
+    ref_idx,idx=acc_reformat.nearest_match(ref,other,t=0.5)
+    # both of the first two ref rows are nearest to other[0], the closer one gets it; the last one is more than 0.5 s away
+    assert ref_idx.tolist()==[1]
+    assert idx.tolist()==[0]
+
+def test_no_matching_records():
+    # x, y, and z records that are all more than 0.5 s apart give an empty table, as before
+    x,y,z=make_streams(20,seed=4)
+    y=y.assign(date_time=y['date_time']+pd.Timedelta(seconds=100))
+    z=z.assign(date_time=z['date_time']+pd.Timedelta(seconds=200))
+    df=acc_reformat.acc_calculate(acc_reformat.acc_flatten(pd.concat([x,y,z],ignore_index=True)))
+    assert len(df)==0
+    assert list(df.columns)==['acx','acy','acz','date_time','seconds','bin','g_force']
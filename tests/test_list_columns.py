@@ -0,0 +1,49 @@
+from ast import literal_eval
+import numpy as np
+import pandas as pd
+import pytest
+from data_io import parse_list_column, stack_list_column, load_ac
+
+# Checks of the bulk list parser against ast.literal_eval, which the pipeline used before to read the data column of _ac.csv
+
+def reference(strings,width=None):
+    lists = [[] if s is None or str(s).strip('[] ') == '' else literal_eval(s) for s in strings]
+    if width is None:
+        width = max([len(x) for x in lists],default=0)
+    out = np.full((len(strings),width),np.nan)
+    for i,values in enumerate(lists):
+        values = values[:width]
+        out[i,:len(values)] = values
+    return out
+
+@pytest.mark.parametrize('strings',[
+    ['[]','[1.5, -0.7]','[0.1, 0.2, 0.3]'],             # empty at the start
+    ['[1.5, -0.7]',None,'','[0.1, 0.2, 0.3]'],          # missing and empty in the middle
+    ['[1.5, -0.7]','[]'],                               # empty at the end
+    ['[1.5, -0.7]',None,None],                          # missing at the end
+    [None,'[1, 2]','[]',None,'[3]',''],                 # all of them
+])
+def test_empty_entries(strings):
+    values = parse_list_column(strings)
+    assert values.shape[0] == len(strings)
+    np.testing.assert_array_equal(values,reference(strings))
+
+def test_width():
+    strings = ['[1, 2, 3, 4]','[]','[5]']
+    np.testing.assert_array_equal(parse_list_column(strings,width=2),reference(strings,2))
+    np.testing.assert_array_equal(parse_list_column(strings,width=6),reference(strings,6))
+    assert parse_list_column(['[]',None]).shape == (2,0)
+    assert parse_list_column([]).shape == (0,0)
+
+def test_stack_matches_parse():
+    lists = [[],[1.5,-0.7],None,[0.1,0.2,0.3],[]]
+    strings = [None if x is None else str(x) for x in lists]
+    np.testing.assert_array_equal(stack_list_column(lists),parse_list_column(strings))
+
+def test_load_ac_empty_last_record(tmp_path):
+    ac_file = tmp_path / '0_day_ac.csv'
+    pd.DataFrame({'kind':['acx','acx'],'date_time':['2022-01-26 00:00:00','2022-01-26 00:00:00.5'],
+                  'data':['[1, 2, 3, 4, 5]','[]']}).to_csv(ac_file,index=False)
+    ac = load_ac(str(ac_file))
+    assert len(ac) == 2
+    np.testing.assert_array_equal(ac['data'].iloc[1],np.full(5,np.nan))
@@ -0,0 +1,176 @@
+import numpy as np
+import pytest
+from time_intervals import merge_intervals, intersect_intervals, complement_intervals, subtract_intervals, in_intervals
+
+# Property checks of time_intervals against the generator loops it replaced in activity_categorize.py (kept below as the
+# reference, unchanged), and against a brute-force coverage grid.
+# Random intervals have integer ends in [0, 40), so that touching and equal ends are common. An interval [s, e] covers the
+# unit cell [k, k+1] when s <= k and k+1 <= e, and a set of intervals is described by the cells it covers.
+
+def old_merge_intervals(time_intervals):
+    time_intervals.sort()
+    output = []
+    output.append(time_intervals[0])
+    for i in time_intervals[1:]:
+        if output[-1][1] >= i[0]:
+            output[-1][1] = max(output[-1][1],i[1])
+        else:
+            output.append(i)
+    output = np.array(output)
+    return(output)
+
+def old_subtract_intervals(base, sub):
+    base_gen, sub_gen = (list(x) for x in base), (x for x in sub)
+    a, b = next(base_gen),next(sub_gen)
+    out_list = []
+    while True:
+        if not old_check_overlap(a,b):
+            if a[1] < b[0]:
+                out_list.append(a)
+                try:
+                    a = next(base_gen)
+                except StopIteration:
+                    break
+            else:
+                try:
+                    b = next(sub_gen)
+                except StopIteration:
+                    remaining_base = [x for x in base_gen]
+                    out_list.append(a)
+                    out_list = out_list + remaining_base
+                    break
+        else:
+            if a[1] <= b[1]:
+                if a[0] <= b[0]:
+                    out_list.append([a[0],b[0]])
+                try:
+                    a = next(base_gen)
+                except StopIteration:
+                    break
+            else:
+                if a[0] <= b[0]:
+                    out_list.append([a[0],b[0]])
+                a = [b[1],a[1]]
+                try:
+                    b = next(sub_gen)
+                except StopIteration:
+                    remaining_base = [x for x in base_gen]
+                    out_list.append(a)
+                    out_list = out_list + remaining_base
+                    break
+    return(np.array(out_list))
+
+def old_check_overlap(interval_a, interval_b):
+    if (interval_a[0] < interval_b[0] and interval_a[1] < interval_b[0]) or (interval_a[0] > interval_b[1] and interval_a[1] > interval_b[1]):
+        return(False)
+    else:
+        return(True)
+
+GRID = 40
+
+def random_intervals(rng,n,min_length=0):
+    starts = rng.integers(0,GRID-min_length,n)
+    ends = np.minimum(starts + rng.integers(min_length,12,n),GRID)
+    return np.column_stack((starts,ends))
+
+def coverage(intervals):
+    covered = np.zeros(GRID,dtype=bool)
+    for s,e in np.asarray(intervals).reshape(-1,2):
+        covered[s:e] = True
+    return covered
+
+def positive_length(intervals):
+    intervals = np.asarray(intervals).reshape(-1,2)
+    return intervals[intervals[:,1] > intervals[:,0]]
+
+def assert_disjoint_sorted(intervals):
+    assert (intervals[:,1] > intervals[:,0]).all()
+    assert (intervals[1:,0] > intervals[:-1,1]).all() # merged intervals do not touch
+
+@pytest.fixture
+def cases():
+    rng = np.random.default_rng(0)
+    return [(random_intervals(rng,rng.integers(1,8)),random_intervals(rng,rng.integers(1,8),min_length=1)) for _ in range(2000)]
+
+def test_merge_matches_old(cases):
+    for a,_ in cases:
+        a = a[np.argsort(a[:,0],kind='stable')] # the old version only sorted the ends within each pair
+        assert np.array_equal(merge_intervals(a),old_merge_intervals(a.copy()))
+
+def test_subtract_matches_old(cases):
+    # the old version needs a merged base and sorted sub intervals; its pieces of zero length are left out now
+    for a,b in cases:
+        base, sub = merge_intervals(a), b[np.argsort(b[:,0],kind='stable')]
+        assert np.array_equal(subtract_intervals(base,sub),positive_length(old_subtract_intervals(base,sub)))
+
+def test_union_coverage(cases):
+    for a,b in cases:
+        merged = merge_intervals(np.concatenate((a,b)))
+        assert_disjoint_sorted(positive_length(merged))
+        assert np.array_equal(coverage(merged),coverage(a) | coverage(b))
+
+def test_intersect_coverage(cases):
+    for a,b in cases:
+        base = merge_intervals(a)
+        pieces = intersect_intervals(base,b)
+        assert (pieces[:,1] > pieces[:,0]).all()
+        assert np.array_equal(coverage(pieces),coverage(base) & coverage(b))
+
+def test_complement_coverage(cases):
+    for a,_ in cases:
+        gaps = complement_intervals(a,5,30)
+        assert_disjoint_sorted(gaps)
+        window = np.zeros(GRID,dtype=bool)
+        window[5:30] = True
+        assert np.array_equal(coverage(gaps),window & ~coverage(a))
+
+def test_subtract_coverage(cases):
+    for a,b in cases:
+        pieces = subtract_intervals(a,b)
+        assert (pieces[:,1] > pieces[:,0]).all()
+        assert np.array_equal(coverage(pieces),coverage(a) & ~coverage(b))
+
+def test_in_intervals(cases):
+    for a,_ in cases:
+        times = np.arange(GRID + 1)
+        expected = np.array([((a[:,0] <= t) & (t <= a[:,1])).any() for t in times])
+        assert np.array_equal(in_intervals(times,a),expected)
+
+def test_no_zero_length_pieces():
+    base = np.array([[0,10]])
+    sub = np.array([[0,3]])
+    assert old_subtract_intervals(base,sub).tolist() == [[0,0],[3,10]]
+    assert subtract_intervals(base,sub).tolist() == [[3,10]]
+
+def test_zero_length_sub():
+    # a sub interval of zero length (e.g. a sleep record of 0 minutes) covers nothing: the old version cut the base in two
+    # pieces that touch there, the base is now kept whole
+    base = np.array([[4,7],[10,33]])
+    sub = np.array([[29,29]])
+    assert old_subtract_intervals(base,sub).tolist() == [[4,7],[10,29],[29,33]]
+    assert subtract_intervals(base,sub).tolist() == [[4,7],[10,33]]
+    assert complement_intervals(sub,0,40).tolist() == [[0,40]]
+    rng = np.random.default_rng(1)
+    for _ in range(2000):
+        base = merge_intervals(random_intervals(rng,rng.integers(1,8)))
+        sub = random_intervals(rng,rng.integers(1,8))
+        sub = sub[np.argsort(sub[:,0],kind='stable')]
+        assert np.array_equal(coverage(subtract_intervals(base,sub)),coverage(positive_length(old_subtract_intervals(base,sub))))
+
+def test_empty_inputs():
+    base = np.array([[0,10],[20,30]])
+    empty = np.empty((0,2),dtype=int)
+    with pytest.raises(StopIteration):
+        old_subtract_intervals(base,empty)
+    assert subtract_intervals(base,empty).tolist() == base.tolist()
+    assert subtract_intervals(empty,base).shape == (0,2)
+    assert merge_intervals([]).shape == (0,2)
+    assert intersect_intervals(base,[]).shape == (0,2)
+    assert complement_intervals([],0,5).tolist() == [[0,5]]
+
+def test_datetime_intervals():
+    t = np.datetime64('2022-01-26T00:00')
+    m = np.timedelta64(1,'m')
+    base = np.array([[t,t + 60*m]])
+    sub = np.array([[t + 10*m,t + 20*m],[t + 15*m,t + 30*m]])
+    assert subtract_intervals(base,sub).tolist() == np.array([[t,t + 10*m],[t + 30*m,t + 60*m]]).tolist()
@@ -0,0 +1,72 @@
+import numpy as np
+
+# Interval algebra on time intervals, used by activity_categorize.py
+# Intervals are (n, 2) arrays of [start, end] pairs (datetime64, or any other sortable numbers).
+# The functions work on whole arrays (sorting, cumulative max, searchsorted) instead of looping over the intervals.
+# Intervals that touch (one ends where the next starts) are merged, and pieces of zero length are left out of the results.
+
+# Function to make an (n, 2) array from a list or array of [start, end] pairs (an empty input gives shape (0, 2))
+def as_intervals(intervals):
+    intervals = np.asarray(intervals)
+    if intervals.size == 0:
+        return intervals.reshape(0,2)
+    return intervals
+
+# Union: sort by start and merge all intervals that overlap or touch
+# A new merged interval starts wherever an interval starts after the latest end of all intervals before it.
+def merge_intervals(time_intervals):
+    intervals = as_intervals(time_intervals)
+    if len(intervals) == 0:
+        return intervals.copy()
+    intervals = intervals[np.argsort(intervals[:,0],kind='stable')]
+    latest_end = np.maximum.accumulate(intervals[:,1])
+    new_start = np.concatenate(([True],intervals[1:,0] > latest_end[:-1]))
+    last = np.append(np.flatnonzero(new_start)[1:] - 1,len(intervals) - 1)
+    return np.column_stack((intervals[new_start,0],latest_end[last]))
+
+# Intersection: the parts of each interval in base that are covered by the intervals in other
+# The pieces are in the order of base. other is merged first, so that for each base interval the overlapping intervals of other
+# are one block, found with two searchsorted calls.
+def intersect_intervals(base, other):
+    base = as_intervals(base)
+    other = merge_intervals(other)
+    if len(base) == 0 or len(other) == 0:
+        return base[:0].copy()
+    first = np.searchsorted(other[:,1],base[:,0],side='right') # first interval of other ending after the base start
+    stop = np.searchsorted(other[:,0],base[:,1],side='left') # intervals of other starting before the base end
+    counts = np.maximum(stop - first,0)
+    base_idx = np.repeat(np.arange(len(base)),counts)
+    other_idx = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,counts) + np.repeat(first,counts)
+    starts = np.maximum(base[base_idx,0],other[other_idx,0])
+    ends = np.minimum(base[base_idx,1],other[other_idx,1])
+    keep = ends > starts
+    return np.column_stack((starts[keep],ends[keep]))
+
+# Complement: the gaps between the intervals, within [start, end]
+# start, the merged intervals, and end are laid out in one array and read back as [start, s0], [e0, s1], ..., [en, end]
+# Intervals of zero length cover nothing and would split a gap in two, so they are left out.
+def complement_intervals(time_intervals, start, end):
+    intervals = merge_intervals(time_intervals)
+    intervals = intervals[intervals[:,1] > intervals[:,0]]
+    bounds = [np.asarray([start]),intervals.ravel(),np.asarray([end])] if len(intervals) > 0 else [np.asarray([start,end])]
+    gaps = np.concatenate(bounds).reshape(-1,2)
+    gaps[:,0] = np.maximum(gaps[:,0],start)
+    gaps[:,1] = np.minimum(gaps[:,1],end)
+    return gaps[gaps[:,1] > gaps[:,0]]
+
+# Subtraction: the parts of each interval in base that are not covered by any interval in sub, in the order of base
+def subtract_intervals(base, sub):
+    base = as_intervals(base)
+    if len(base) == 0:
+        return base.copy()
+    return intersect_intervals(base,complement_intervals(sub,base[:,0].min(),base[:,1].max()))
+
+# Function to find which times are within any of the intervals (start and end included), without looping over the intervals
+# Each time is matched to the last merged interval starting at or before it, and is inside if it is not after its end.
+def in_intervals(times, time_intervals):
+    intervals = merge_intervals(time_intervals)
+    times = np.asarray(times)
+    if len(intervals) == 0:
+        return np.zeros(len(times),dtype=bool)
+    idx = np.searchsorted(intervals[:,0],times,side='right') - 1
+    return (idx >= 0) & (times <= intervals[np.maximum(idx,0),1])